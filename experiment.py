@@ -5,8 +5,15 @@ import os
 import sys
 import time
 import multiprocessing
-from multiprocessing import Queue
+import threading
+import itertools
+import json
+import socket
+import tempfile
+from Queue import Queue as WriteQueue
+from collections import OrderedDict
 from sklearn import svm
+from sklearn.neighbors import BallTree
 import maxflow
 
 def mask_from_image(image,imtype):
@@ -111,6 +118,43 @@ def get_quantized_images(rimages,qbins,imtype):
     qimages = [get_quantized_image(i,qbins,imtype) for i in rimages]
     return qimages
     
+#Compact colour bins
+#only the bins occupied in the training images get their own index, 0..m-1, and
+#every other bin, including colours first seen at test time, shares index m.
+#histograms then have m+1 bins instead of qbins**3, and since histograms are
+#regularized by +1 an unseen colour still gets a count of one, as with dense bins.
+#every bin a compact histogram leaves out would also hold a count of one, so
+#normalizing with dense_bins (qbins**3) in get_minus_log_prob_pixels gives exactly
+#the dense probabilities. a test image's own histograms keep its unseen colours
+#apart, see map_test_bins
+#returns the map from dense to compact bins and the number of compact bins
+def get_bin_map(qimages,qbins):
+    occupied = np.zeros(qbins**3,'bool')
+    for qim in qimages:
+        occupied[qim] = True
+        
+    n_occupied = int(np.sum(occupied))
+    bin_map = np.empty(qbins**3,'uint32')
+    bin_map.fill(n_occupied)
+    bin_map[occupied] = np.arange(n_occupied)
+    return bin_map,n_occupied+1
+    
+def remap_quantized_images(qimages,bin_map):
+    return [bin_map[qim] for qim in qimages]
+    
+#a test image through bin_map, for the global histograms, and with each of its colours
+#unseen in training given its own index from totalbins on, for histograms of the image
+#itself. returns both, and the number of bins of the second
+def map_test_bins(qtest,bin_map,totalbins):
+    qglobal = bin_map[qtest]
+    unseen = qglobal == totalbins-1
+    if not np.any(unseen):
+        return qglobal,qglobal,totalbins
+    colours,local = np.unique(qtest[unseen],return_inverse=True)
+    qlocal = qglobal.copy()
+    qlocal[unseen] = totalbins + local
+    return qglobal,qlocal,totalbins+len(colours)
+    
 #as specified in paper:
 #
 def get_manfredi_hog_features(image):
@@ -217,13 +261,20 @@ def get_global_histograms(qimages,masks,bins):
     return fore_global,back_global
     
 
-def get_minus_log_prob_pixels(qimage,hist):
+#hist must be regularized (no bin zero). dense_bins is the number of bins of the dense
+#histogram when hist is compact, the bins it leaves out each count one
+def get_minus_log_prob_pixels(qimage,hist,dtype='float64',dense_bins=None):
     sumhist = hist.sum()
-    probs = hist[qimage]/float(sumhist)
-    return -np.log(probs)
+    if dense_bins is not None:
+        sumhist += dense_bins - len(hist)
+    probs = hist[qimage].astype(dtype)
+    probs /= float(sumhist)
+    np.log(probs,out=probs)
+    np.negative(probs,out=probs)
+    return probs
 
 #Calculate \sum_{p=1}^P L(x_{ip} | y_{ip},F,B)
-def get_fidelity_to_histogram(qimage,mask,forehist,backhist):
+def get_fidelity_to_histogram(qimage,mask,forehist,backhist,dtype='float64',dense_bins=None):
 
     #for each pixel in rimage:
     #if foreground get loss to background
@@ -232,15 +283,15 @@ def get_fidelity_to_histogram(qimage,mask,forehist,backhist):
     #sumfore = forehist.sum()
     rows,cols = qimage.shape
     
-    fidmap = np.zeros(qimage.shape) 
+    fidmap = np.zeros(qimage.shape,dtype) 
     
     #backprobs = backhist[qimage]/float(sumback)
     #backfidelities = -np.log(backprobs)
-    backfidelities = get_minus_log_prob_pixels(qimage,backhist)    
+    backfidelities = get_minus_log_prob_pixels(qimage,backhist,dtype,dense_bins)
     
     #foreprobs = forehist[qimage]/float(sumfore)
     #forefidelities = -np.log(foreprobs)
-    forefidelities = get_minus_log_prob_pixels(qimage,forehist)
+    forefidelities = get_minus_log_prob_pixels(qimage,forehist,dtype,dense_bins)
     
     fidmap[mask] = backfidelities[mask]
     backmask = np.logical_not(mask)
@@ -261,162 +312,550 @@ def omega1(mask1,mask2):
     npixels = mask1.shape[0]*mask1.shape[1]
     return total_same/float(npixels)
     
-def omega2(qim1,qim2,mask1,mask2,bins):
+def omega2(qim1,qim2,mask1,mask2,bins,dtype='float64',dense_bins=None):
     #get the histograms of mask 2 applied to image 1
     forehist,backhist = get_image_histogram(qim1,mask2,bins,True)
-    fidelity,_ = get_fidelity_to_histogram(qim1,mask1,forehist,backhist)
+    fidelity,_ = get_fidelity_to_histogram(qim1,mask1,forehist,backhist,dtype,dense_bins)
     return fidelity
     
-def omega3(qim1,qim2,mask1,mask2,global_forehist,global_backhist):
-    im1fidelity,_ = get_fidelity_to_histogram(qim1,mask1,global_forehist,global_backhist)
-    im2fidelity,_ = get_fidelity_to_histogram(qim2,mask2,global_forehist,global_backhist)
+def omega3(qim1,qim2,mask1,mask2,global_forehist,global_backhist,dtype='float64',dense_bins=None):
+    im1fidelity,_ = get_fidelity_to_histogram(qim1,mask1,global_forehist,global_backhist,dtype,dense_bins)
+    im2fidelity,_ = get_fidelity_to_histogram(qim2,mask2,global_forehist,global_backhist,dtype,dense_bins)
     return im1fidelity*im2fidelity
 
-def get_kernels(feat1,feat2,qim1,qim2,mask1,mask2,global_forehist,global_backhist,bins,sigma):
+#dtype is the precision of every per-pixel map, 'float32' halves their memory traffic
+#dense_bins is qbins**3 when bins are compact (see get_bin_map)
+def get_kernels(feat1,feat2,qim1,qim2,mask1,mask2,global_forehist,global_backhist,bins,sigma,\
+                    dtype='float64',dense_bins=None):
     thetaval = theta(feat1,feat2,sigma)
     o1val = omega1(mask1,mask2)
-    o2val = omega2(qim1,qim2,mask1,mask2,bins)
-    o3val = omega3(qim1,qim2,mask1,mask2,global_forehist,global_backhist)
+    o2val = omega2(qim1,qim2,mask1,mask2,bins,dtype,dense_bins)
+    o3val = omega3(qim1,qim2,mask1,mask2,global_forehist,global_backhist,dtype,dense_bins)
     #print 'values be ',thetaval,o1val,o2val,o3val
     return thetaval,o1val,o2val,o3val
    
-#calculate part of the gram matrix and save to disk
-#done this way to allow for multiprocessing
-def get_partial_kernels(n_images,rowstart,rowend,imfeatures,qimages,masks\
-                    ,fore_global_hist,back_global_hist,totalbins,sigma):
+#kernels between images rowstart..rowend and colstart..colend (inclusive)
+#claim_path, if given, is touched every row so the reducer can tell the tile is alive
+def get_kernel_block(rowstart,rowend,colstart,colend,imfeatures,qimages,masks\
+                    ,fore_global_hist,back_global_hist,totalbins,sigma,dtype='float64',claim_path=None,\
+                    dense_bins=None,verbose=True):
                         
-        kernels = np.zeros((rowend-rowstart+1,n_images,4))
+        kernels = np.zeros((rowend-rowstart+1,colend-colstart+1,4),dtype)
         for i in range(rowstart,rowend+1):
-            sys.stdout.write( "Row {0} out of {1}\n".format(i,rowend))
-            sys.stdout.flush()
-            for j in range(n_images):
+            if verbose:
+                sys.stdout.write( "Row {0} out of {1}\n".format(i,rowend))
+                sys.stdout.flush()
+            if claim_path is not None:
+                try:
+                    os.utime(claim_path,None)
+                except OSError:
+                    pass #claim went stale and was reissued, finish the tile anyway
+            for j in range(colstart,colend+1):
                 feat1,feat2 = imfeatures[i],imfeatures[j]
                 qim1,qim2 = qimages[i],qimages[j]
                 mask1,mask2 = masks[i],masks[j]
                 theta,omega1,omega2,omega3 = get_kernels(feat1,feat2,qim1,qim2,mask1,mask2,\
-                            fore_global_hist,back_global_hist,totalbins,sigma)
-                kernels[i-rowstart,j,0] = theta
-                kernels[i-rowstart,j,1] = omega1
-                kernels[i-rowstart,j,2] = omega2
-                kernels[i-rowstart,j,3] = omega3
-        np.save('subkernels{0}.npy'.format(rowstart),kernels)
+                            fore_global_hist,back_global_hist,totalbins,sigma,dtype,dense_bins)
+                kernels[i-rowstart,j-colstart,0] = theta
+                kernels[i-rowstart,j-colstart,1] = omega1
+                kernels[i-rowstart,j-colstart,2] = omega2
+                kernels[i-rowstart,j-colstart,3] = omega3
+        return kernels
+
+#the kernels tensor is stored channel-major, (4,n,n) with theta,omega1,omega2,omega3,
+#as a .npy file that is memory-mapped rather than read into memory
+def create_kernel_file(kernel_path,n_images,dtype='float64'):
+    return np.lib.format.open_memmap(kernel_path,mode='w+',dtype=dtype,shape=(4,n_images,n_images))
+    
+def load_kernel_file(kernel_path):
+    return np.load(kernel_path,mmap_mode='r')
+
+#calculate part of the gram matrix and write it to the kernel file
+#done this way to allow for multiprocessing
+#one row at a time, so a process never holds more than a row of kernels
+def get_partial_kernels(n_images,rowstart,rowend,imfeatures,qimages,masks\
+                    ,fore_global_hist,back_global_hist,totalbins,sigma,dtype='float64',\
+                    kernel_path='kernels.npy',dense_bins=None):
+                        
+        kernels = np.load(kernel_path,mmap_mode='r+')
+        for i in range(rowstart,rowend+1):
+            sys.stdout.write( "Row {0} out of {1}\n".format(i,rowend))
+            sys.stdout.flush()
+            row = get_kernel_block(i,i,0,n_images-1,imfeatures,qimages,masks,\
+                            fore_global_hist,back_global_hist,totalbins,sigma,dtype,\
+                            dense_bins=dense_bins,verbose=False)
+            kernels[:,i,:] = row[0].T
+        kernels.flush()
+        del kernels
 
 def get_all_kernels(n_processes,n_images,imfeatures,qimages,masks\
-                    ,fore_global_hist,back_global_hist,totalbins,sigma):
+                    ,fore_global_hist,back_global_hist,totalbins,sigma,dtype='float64',\
+                    kernel_path='kernels.npy',dense_bins=None):
 
+    kernels = create_kernel_file(kernel_path,n_images,dtype)
+    kernels.flush()
+    del kernels
+    
     jobs = []
-    rowstarts = []
     chunk_size = int(n_images/n_processes)
     for rs in range(0,n_images,chunk_size):
-        rowstarts.append(rs)
         rowend = min(rs+chunk_size-1,n_images-1)
             
         args = (n_images,rs,rowend,imfeatures,qimages,masks,\
-                fore_global_hist,back_global_hist,totalbins,sigma)
+                fore_global_hist,back_global_hist,totalbins,sigma,dtype,kernel_path,dense_bins)
         proc = multiprocessing.Process(target=get_partial_kernels, args=args)
         jobs.append(proc)
         proc.start()
         
     for proc in jobs:
         proc.join()
-        #now join the resulting matrices
-    part_grams = tuple(np.load('subkernels{0}.npy'.format(rs)) for rs in rowstarts)
-    kernels = np.vstack(part_grams)
     
-    np.save('kernels.npy',kernels)
+    return load_kernel_file(kernel_path)
+    
+#Pyramid kernels, with the omega terms computed on every 2**level-th pixel
+#quantized colours can't be averaged, so levels subsample rather than smooth
+#theta still comes from the full resolution HOG features
+def get_pyramid_level(qimages,masks,level):
+    step = 2**level
+    return [q[::step,::step] for q in qimages],[m[::step,::step] for m in masks]
+    
+#recompute the omega terms of the given (row,col) pairs at full resolution
+def refine_partial_kernels(kernel_path,pairs,qimages,masks,fore_global_hist,back_global_hist,\
+                    totalbins,dtype='float64',dense_bins=None):
+    kernels = np.load(kernel_path,mmap_mode='r+')
+    for i,j in pairs:
+        kernels[1,i,j] = omega1(masks[i],masks[j])
+        kernels[2,i,j] = omega2(qimages[i],qimages[j],masks[i],masks[j],totalbins,dtype,dense_bins)
+        kernels[3,i,j] = omega3(qimages[i],qimages[j],masks[i],masks[j],\
+                            fore_global_hist,back_global_hist,dtype,dense_bins)
+    kernels.flush()
+    del kernels
+    
+#refine every pair with theta above refine_theta, the pairs that weigh most in the gram
+def refine_kernels(n_processes,kernel_path,refine_theta,qimages,masks,fore_global_hist,back_global_hist,\
+                    totalbins,dtype='float64',dense_bins=None):
+    rows,cols = np.where(load_kernel_file(kernel_path)[0] > refine_theta)
+    pairs = zip(rows,cols)
+    print 'Refining',len(pairs),'kernel pairs at full resolution'
+    
+    jobs = []
+    for p in range(n_processes):
+        args = (kernel_path,pairs[p::n_processes],qimages,masks,fore_global_hist,back_global_hist,\
+                totalbins,dtype,dense_bins)
+        proc = multiprocessing.Process(target=refine_partial_kernels, args=args)
+        jobs.append(proc)
+        proc.start()
+        
+    for proc in jobs:
+        proc.join()
+    return load_kernel_file(kernel_path)
+    
+#time the kernels of the first n_images bundled pennfudan images at each level,
+#measure how far their omegas and gram drift from the full resolution ones, and
+#the validation accuracy of a model trained on them, on the next n_valid images
+#(with the pennfudan defaults of run_experiment, no cross validation).
+#the report is also written to results.txt in the benchmark directory
+#python experiment.py pyramid_benchmark runs it
+def benchmark_pyramid_kernels(n_procs,n_images=40,levels=(1,2),refine_theta=None,gram_max_bytes=256*2**20,\
+                                n_valid=20):
+    qbins,sigma,betas,nu,lambda_coef = 20,.5,(1.0,1.0,0.05),.24,1.0
+    totalbins = int(qbins**3)
+    impaths,maskpaths = get_image_paths('pennfudan')
+    allimages,allmasks,all_labels = load_images('pennfudan',n_images+n_valid,impaths,maskpaths)
+    rimages,masks = allimages[:n_images],allmasks[:n_images]
+    validimages,validmasks,validlabels = allimages[n_images:],allmasks[n_images:],all_labels[n_images:]
+    qimages = get_quantized_images(rimages,qbins,'pennfudan')
+    imfeatures = get_image_features(rimages,'pennfudan')
+    fore_global_hist,back_global_hist = get_global_histograms(qimages,masks,totalbins)
+    
+    bench_dir = 'pyramid_benchmark_' + str(int(time.time()))
+    os.mkdir(bench_dir)
+    
+    report = []
+    for level in (0,)+tuple(levels):
+        kernel_path = os.path.join(bench_dir,'kernels{0}.npy'.format(level))
+        start = time.time()
+        qlevel,mlevel = get_pyramid_level(qimages,masks,level)
+        kernels = get_all_kernels(n_procs,n_images,imfeatures,qlevel,mlevel,\
+                    fore_global_hist,back_global_hist,totalbins,sigma,kernel_path=kernel_path)
+        if level > 0 and refine_theta is not None:
+            kernels = refine_kernels(n_procs,kernel_path,refine_theta,qimages,masks,\
+                    fore_global_hist,back_global_hist,totalbins)
+        elapsed = time.time()-start
+        gram = get_graham_matrix(kernels,betas,np.empty((n_images,n_images),'float64'),gram_max_bytes)
+        
+        if level == 0:
+            full_kernels,full_gram,full_time = kernels,gram,elapsed
+        omega_errors = [np.mean(np.abs(kernels[c]-full_kernels[c]))/np.mean(np.abs(full_kernels[c]))\
+                            for c in [1,2,3]]
+        gram_error = np.max(np.abs(gram-full_gram))/np.max(np.abs(full_gram))
+        
+        alpha,support_vecs,_ = train_one_class_svm(gram,nu)
+        a_acc,o_acc,fg_acc,bg_acc,_ = get_test_accuracy(validimages,validmasks,validlabels,rimages,qimages,\
+                        imfeatures,masks,fore_global_hist,back_global_hist,qbins,totalbins,\
+                        sigma,lambda_coef,'pennfudan',betas,alpha,support_vecs,n_procs=n_procs)
+        accuracy = validation_accuracy('pennfudan',a_acc,o_acc,fg_acc,bg_acc)
+        report.append((level,elapsed,full_time/elapsed,omega_errors,gram_error,accuracy))
+        
+    log_f = open(os.path.join(bench_dir,'results.txt'),'w')
+    log_f.write("{0} training and {1} validation images\n".format(n_images,n_valid))
+    for level,elapsed,speedup,omega_errors,gram_error,accuracy in report:
+        print "Level",level,"took",elapsed,"s, a speedup of",speedup
+        print "    relative omega errors",omega_errors,"and relative gram error",gram_error
+        print "    validation accuracy",accuracy
+        log_f.write("level {0} took {1}s, a speedup of {2}\n".format(level,elapsed,speedup))
+        log_f.write("    relative omega errors {0}, relative gram error {1}\n".format(omega_errors,gram_error))
+        log_f.write("    validation accuracy {0}\n".format(accuracy))
+    log_f.close()
+    return report
+    
+#Distributed kernels, for several machines sharing a filesystem
+#share_dir (an empty directory, a used one is refused) holds
+#   manifest.json             sizes and the (rowstart,rowend,colstart,colend) of every tile
+#   inputs.npz                packed training features, quantized images, masks and histograms
+#   tiles/<t>.todo            tile t waiting for a worker
+#   tiles/<t>.claim.<host>.<pid>  tile t being computed
+#   results/<t>.npy           kernels of tile t
+#a worker claims a tile by renaming its .todo file, which only one rename can do,
+#and touches the claim every row it computes. claims untouched for stale_seconds are
+#taken to belong to a dead worker and reissued
+#python experiment.py kernel_worker <share_dir> joins from any host
+def write_kernel_manifest(share_dir,n_images,imfeatures,qimages,masks\
+                    ,fore_global_hist,back_global_hist,totalbins,sigma,block_size,dtype='float64',\
+                    dense_bins=None):
+    #tiles and results left from another run would be mixed into this one
+    if os.path.isdir(share_dir) and os.listdir(share_dir):
+        raise ValueError("kernel share directory {0} is not empty".format(share_dir))
+    for d in ['tiles','results']:
+        os.makedirs(os.path.join(share_dir,d))
+            
+    np.savez(os.path.join(share_dir,'inputs.npz'),imfeatures=np.array(imfeatures[:n_images]),\
+                qimages=np.array(qimages[:n_images]),masks=np.array(masks[:n_images]),\
+                fore_global_hist=fore_global_hist,back_global_hist=back_global_hist)
+    
+    tiles = []
+    for rs in range(0,n_images,block_size):
+        for cs in range(0,n_images,block_size):
+            tiles.append((rs,min(rs+block_size-1,n_images-1),cs,min(cs+block_size-1,n_images-1)))
+    manifest = {'n_images':n_images,'totalbins':totalbins,'dense_bins':dense_bins,'sigma':sigma,\
+                'dtype':dtype,'tiles':tiles}
+    
+    for t in range(len(tiles)):
+        open(os.path.join(share_dir,'tiles','{0}.todo'.format(t)),'w').close()
+        
+    #written last and renamed into place, workers wait until it appears
+    manifest_f = open(os.path.join(share_dir,'manifest.json.tmp'),'w')
+    json.dump(manifest,manifest_f)
+    manifest_f.close()
+    os.rename(os.path.join(share_dir,'manifest.json.tmp'),os.path.join(share_dir,'manifest.json'))
+    return manifest
+    
+def load_kernel_manifest(share_dir):
+    manifest_f = open(os.path.join(share_dir,'manifest.json'))
+    manifest = json.load(manifest_f)
+    manifest_f.close()
+    return manifest
+    
+def get_tile_result_path(share_dir,t):
+    return os.path.join(share_dir,'results','{0}.npy'.format(t))
+    
+def kernel_tiles_done(share_dir,manifest):
+    return all(os.path.exists(get_tile_result_path(share_dir,t)) for t in range(len(manifest['tiles'])))
+    
+#returns (tile index, claim path), or (None,None) if no tile is waiting
+def claim_kernel_tile(share_dir):
+    tile_dir = os.path.join(share_dir,'tiles')
+    for f in sorted(os.listdir(tile_dir)):
+        if not f.endswith('.todo'):
+            continue
+        t = int(f.split('.')[0])
+        claim = os.path.join(tile_dir,'{0}.claim.{1}.{2}'.format(t,socket.gethostname(),os.getpid()))
+        try:
+            os.rename(os.path.join(tile_dir,f),claim)
+        except OSError:
+            continue #another worker claimed it first
+        #rename keeps the old mtime, and the reducer judges staleness by it
+        try:
+            os.utime(claim,None)
+        except OSError:
+            continue #the reducer already reissued it as stale
+        return t,claim
+    return None,None
+    
+#compute tiles until every tile has a result
+#keeps polling while other workers hold claims, in case they go stale and are reissued
+def run_kernel_worker(share_dir,poll_seconds=5):
+    while not os.path.exists(os.path.join(share_dir,'manifest.json')):
+        time.sleep(poll_seconds)
+    manifest = load_kernel_manifest(share_dir)
+    inputs = np.load(os.path.join(share_dir,'inputs.npz'))
+    imfeatures,qimages,masks = inputs['imfeatures'],inputs['qimages'],inputs['masks']
+    fore_global_hist,back_global_hist = inputs['fore_global_hist'],inputs['back_global_hist']
+    
+    n_done = 0
+    while not kernel_tiles_done(share_dir,manifest):
+        t,claim = claim_kernel_tile(share_dir)
+        if t is None:
+            time.sleep(poll_seconds)
+            continue
+            
+        rowstart,rowend,colstart,colend = manifest['tiles'][t]
+        kernels = get_kernel_block(rowstart,rowend,colstart,colend,imfeatures,qimages,masks,\
+                            fore_global_hist,back_global_hist,manifest['totalbins'],manifest['sigma'],\
+                            manifest['dtype'],claim,manifest['dense_bins'])
+        
+        #write then rename, so a result file is never seen half written
+        result = get_tile_result_path(share_dir,t)
+        tmp = '{0}.{1}.{2}.tmp'.format(result,socket.gethostname(),os.getpid())
+        tmp_f = open(tmp,'wb')
+        np.save(tmp_f,kernels)
+        tmp_f.close()
+        os.rename(tmp,result)
+        try:
+            os.remove(claim)
+        except OSError:
+            pass #claim went stale and was reissued, the duplicate result is harmless
+        n_done += 1
+        
+    return n_done
+    
+#wait for every tile, reissuing claims untouched for stale_seconds, then assemble kernels.npy
+#in share_dir, in the layout of create_kernel_file
+#jobs are the local worker processes, if they have all failed with tiles left it gives up
+#rather than wait on workers that may not exist elsewhere
+def reduce_kernels(share_dir,stale_seconds=600,poll_seconds=5,jobs=()):
+    manifest = load_kernel_manifest(share_dir)
+    tile_dir = os.path.join(share_dir,'tiles')
+    
+    while not kernel_tiles_done(share_dir,manifest):
+        if jobs and all(not p.is_alive() and p.exitcode != 0 for p in jobs):
+            raise RuntimeError("every local kernel worker failed with tiles left in {0}".format(share_dir))
+        now = time.time()
+        for f in os.listdir(tile_dir):
+            if '.claim.' not in f:
+                continue
+            t = int(f.split('.')[0])
+            claim = os.path.join(tile_dir,f)
+            try:
+                stale = now - os.path.getmtime(claim) > stale_seconds
+                if stale and not os.path.exists(get_tile_result_path(share_dir,t)):
+                    os.rename(claim,os.path.join(tile_dir,'{0}.todo'.format(t)))
+                    print 'Reissuing stale kernel tile',t
+            except OSError:
+                pass #worker finished while we looked
+        time.sleep(poll_seconds)
+        
+    kernel_path = os.path.join(share_dir,'kernels.npy')
+    kernels = create_kernel_file(kernel_path,manifest['n_images'],manifest['dtype'])
+    for t,(rowstart,rowend,colstart,colend) in enumerate(manifest['tiles']):
+        tile = np.load(get_tile_result_path(share_dir,t))
+        kernels[:,rowstart:rowend+1,colstart:colend+1] = tile.transpose(2,0,1)
+    kernels.flush()
+    del kernels
+        
+    return load_kernel_file(kernel_path)
+    
+#same result as get_all_kernels, with local worker processes taking tiles
+#from share_dir alongside any started on other hosts
+def get_distributed_kernels(n_processes,share_dir,n_images,imfeatures,qimages,masks\
+                    ,fore_global_hist,back_global_hist,totalbins,sigma,block_size=None,dtype='float64',\
+                    dense_bins=None):
+    if block_size is None:
+        block_size = max(1,int(n_images/n_processes))
+        
+    write_kernel_manifest(share_dir,n_images,imfeatures,qimages,masks,\
+                fore_global_hist,back_global_hist,totalbins,sigma,block_size,dtype,dense_bins)
+    
+    jobs = []
+    for p in range(n_processes):
+        proc = multiprocessing.Process(target=run_kernel_worker, args=(share_dir,))
+        jobs.append(proc)
+        proc.start()
+        
+    kernels = reduce_kernels(share_dir,jobs=jobs)
+    for proc in jobs:
+        proc.join()
+        
     return kernels
     
 #used for crossvalidating over simga
 #theta relatively inexpensive to replace, but still takes a while 
 def replace_theta(kernels,imfeatures,newsigma):
-    n_images = kernels.shape[0]
-    newkernels = kernels.copy()
+    n_images = kernels.shape[1]
+    newkernels = np.array(kernels)
     
     for i in range(n_images):
         for j in range(n_images):
-            newkernels[i,j,0] = theta(imfeatures[i],imfeatures[j],newsigma)
+            newkernels[0,i,j] = theta(imfeatures[i],imfeatures[j],newsigma)
             
     return newkernels
     
-def get_graham_matrix(kernels,betas):
-    theta = kernels[:,:,0]
-    omega1,omega2,omega3 = kernels[:,:,1],kernels[:,:,2],kernels[:,:,3]
-    return theta * (betas[0]*omega1 + betas[1]*omega2 + betas[2]*omega3)
+#theta * (beta1*omega1 + beta2*omega2 + beta3*omega3), assembled a block of rows at a time
+#into out (allocated if not given), in the precision of out
+#at most max_bytes of kernels and scratch are in memory at once, and no other
+#n x n temporaries are made
+def get_graham_matrix(kernels,betas,out=None,max_bytes=256*2**20):
+    n_images = kernels.shape[1]
+    if out is None:
+        out = np.empty((n_images,n_images),kernels.dtype)
+        
+    itemsize = max(kernels.dtype.itemsize,out.dtype.itemsize)
+    block_rows = max(1,int(max_bytes/(5*n_images*itemsize)))
+    scratch = np.empty((block_rows,n_images),out.dtype)
+    
+    for rs in range(0,n_images,block_rows):
+        re = min(rs+block_rows,n_images)
+        block,tmp = out[rs:re],scratch[:re-rs]
+        np.multiply(kernels[1,rs:re],betas[0],out=block,dtype=out.dtype)
+        np.multiply(kernels[2,rs:re],betas[1],out=tmp,dtype=out.dtype)
+        block += tmp
+        np.multiply(kernels[3,rs:re],betas[2],out=tmp,dtype=out.dtype)
+        block += tmp
+        np.multiply(block,kernels[0,rs:re],out=block,dtype=out.dtype)
+    return out
+
+#thetas between one feature and the features of many images, in one pass
+def get_thetas(feat,feats,sigma):
+    dists = np.sqrt(np.sum((np.asarray(feats,'float64')-feat)**2,axis=1))
+    return np.exp(-dists/(2*sigma*sigma))
+    
+#gamma of each support vector, its fidelity to the global histograms
+#depends only on the trained model, so can be computed once for many test images
+def get_support_gammas(qimages,masks,support_vecs,global_forehist,global_backhist,dtype='float64',\
+                        dense_bins=None):
+    gammas = []
+    for idx in support_vecs:
+        svecfidelity,_ = get_fidelity_to_histogram(qimages[idx],masks[idx],global_forehist,global_backhist,\
+                                dtype,dense_bins)
+        gammas.append(float(svecfidelity))
+    return np.array(gammas)
 
+#Support vector index, built once per trained model
+#theta is exp(-dist/(2 sigma^2)), so alpha*theta > tol exactly when
+#dist < 2 sigma^2 log(alpha/tol), and one radius query using the largest alpha
+#finds every support vector that can pass the tolerance
+def build_sv_index(imfeatures,support_vecs,alpha,sigma):
+    svfeatures = np.array([imfeatures[idx] for idx in support_vecs],'float64')
+    return {'tree':BallTree(svfeatures),'svfeatures':svfeatures,\
+            'alpha':np.asarray(alpha,'float64'),'sigma':sigma}
+    
+#returns positions (into support_vecs) of the support vectors with alpha*theta > tol,
+#the positions of the two closest (just the one if there is only one), which are always
+#kept, closest first, the fraction of the alpha*theta mass left out and the thetas of
+#the selected support vectors. unless exact_mass, that fraction is an upper bound,
+#taking every dropped support vector to weigh tol
+def query_sv_index(sv_index,feat,tol,exact_mass=False):
+    tree,alpha,sigma = sv_index['tree'],sv_index['alpha'],sv_index['sigma']
+    feat = np.asarray(feat,'float64').reshape(1,-1)
+    
+    closest = tree.query(feat,k=min(2,len(alpha)),return_distance=False)[0]
+    radius = max(2*sigma*sigma*np.log(alpha.max()/tol),0)
+    near,dists = tree.query_radius(feat,radius,return_distance=True)
+    near,dists = near[0],dists[0]
+    
+    weights = alpha[near]*np.exp(-dists/(2*sigma*sigma))
+    selected = np.union1d(near[weights > tol],closest)
+    
+    n_dropped = len(alpha)-len(selected)
+    if exact_mass:
+        all_thetas = get_thetas(feat[0],sv_index['svfeatures'],sigma)
+        thetas = all_thetas[selected]
+        dropped = 1-(alpha[selected]*thetas).sum()/(alpha*all_thetas).sum()
+    else:
+        thetas = get_thetas(feat[0],sv_index['svfeatures'][selected],sigma)
+        kept_mass = (alpha[selected]*thetas).sum()
+        dropped = n_dropped*tol/(kept_mass+n_dropped*tol)
+    return selected,closest,dropped,thetas
+    
+#dtype is the precision of the potential maps
+#support vector weights are kept as python floats so they never upcast the maps
+#feattest, gammas and the thetas of the support vectors can be passed in when the
+#caller already has them, as can closest, the training images of the two support
+#vectors with the highest theta (shown as the closest matches)
+#bin_map is the map from get_bin_map when qimages use compact bins
 def get_unary_potentials(testimg,rimages,qimages,imfeatures,masks,global_forehist,\
                             global_backhist,qbins,totalbins,sigma,imtype,\
-                            betas,alpha,support_vecs):
+                            betas,alpha,support_vecs,dtype='float64',feattest=None,gammas=None,\
+                            bin_map=None,thetas=None,closest=None):
     #first resize test image to the correct size and gather features
     rtest = cv2.resize(testimg,(qimages[0].shape[1],qimages[0].shape[0]))
     qtest = get_quantized_image(rtest,qbins,imtype)
-    feattest = get_image_feature(rtest,imtype)
+    #qlocal and localbins are for histograms of the test image itself
+    qlocal,localbins,dense_bins = qtest,totalbins,None
+    if bin_map is not None:
+        qtest,qlocal,localbins = map_test_bins(qtest,bin_map,totalbins)
+        dense_bins = len(bin_map)
+    if feattest is None:
+        feattest = get_image_feature(rtest,imtype)
     #based on test image (j) compared to each support vector image-mask (i)
     
     #the test part of these coefficients, as defined in the paper
     #L(x_{jp} | B_G)
-    pf3ip_test = get_minus_log_prob_pixels(qtest,global_backhist)
+    pf3ip_test = get_minus_log_prob_pixels(qtest,global_backhist,dtype,dense_bins)
     #L(X_{jp} | F_G)
-    pb3ip_test = get_minus_log_prob_pixels(qtest,global_forehist)
+    pb3ip_test = get_minus_log_prob_pixels(qtest,global_forehist,dtype,dense_bins)
     
-    thetas = []
     fore_hists = []
     back_hists = []
-    gammas = []
+    if thetas is None:
+        thetas = get_thetas(feattest,[imfeatures[idx] for idx in support_vecs],sigma)
+    weights = np.asarray(alpha,'float64')*thetas
+    if closest is None:
+        closest = [support_vecs[pos] for pos in np.argsort(thetas)[::-1][:2]]
+    bt1 = rimages[closest[0]]
+    bt2 = rimages[closest[-1]]
+    
+    if gammas is None:
+        gammas = get_support_gammas(qimages,masks,support_vecs,global_forehist,global_backhist,dtype,dense_bins)
     
     
-    fore_potential = np.zeros(qtest.shape)    
-    back_potential = np.zeros(qtest.shape)
+    fore_potential = np.zeros(qtest.shape,dtype)    
+    back_potential = np.zeros(qtest.shape,dtype)
     
-    fore_beta1 = np.zeros(qtest.shape)  
-    fore_beta2 = np.zeros(qtest.shape)  
-    fore_beta3 = np.zeros(qtest.shape)  
+    fore_beta1 = np.zeros(qtest.shape,dtype)  
+    fore_beta2 = np.zeros(qtest.shape,dtype)  
+    fore_beta3 = np.zeros(qtest.shape,dtype)  
     
     #get infomation for each support vector
     for i,idx in enumerate(support_vecs):
         #if i%100 ==0:
         #    print 'support vec info ',idx
-        #same as typical
-        thetas.append(theta(feattest,imfeatures[idx],sigma))
-        forehist,backhist = get_image_histogram(qtest,masks[idx],totalbins,True)
+        forehist,backhist = get_image_histogram(qlocal,masks[idx],localbins,True)
         fore_hists.append(forehist)
         back_hists.append(backhist)
         
-        svecfidelity,_ = get_fidelity_to_histogram(qimages[idx],masks[idx],global_forehist,global_backhist)
-        gammas.append(svecfidelity)
-        
-    best_thetas = sorted(enumerate(thetas),key= lambda t:t[1])
-    bt1 = rimages[best_thetas[-1][0]]
-    bt2 = rimages[best_thetas[-2][0]]
-    
     for i,idx in enumerate(support_vecs):
         #if i %100 ==0:
         #    print 'support vec term ',i
-        support_theta = thetas[i]
+        weight = float(weights[i])
+        gamma = float(gammas[i])
+        
+        svmask = masks[idx].astype(dtype)
+        back_fidelities = get_minus_log_prob_pixels(qlocal,back_hists[i],dtype,dense_bins)
+        fore_fidelities = get_minus_log_prob_pixels(qlocal,fore_hists[i],dtype,dense_bins)
         
         #support_fore = np.zeros(rtest.shape)    
-        support_fore = betas[0]*masks[idx]
-        support_fore += betas[1] * get_minus_log_prob_pixels(qtest,back_hists[i])
-        support_fore += betas[2] * pf3ip_test * gammas[i]
+        support_fore = betas[0]*svmask
+        support_fore += betas[1] * back_fidelities
+        support_fore += betas[2] * gamma * pf3ip_test
         
-        fore_beta1 += alpha[i]*support_theta*betas[0]*masks[idx]
-        fore_beta2 += alpha[i]*support_theta*betas[1] * get_minus_log_prob_pixels(qtest,back_hists[i])
-        fore_beta3 += alpha[i]*support_theta*betas[2] * pf3ip_test * gammas[i]
+        fore_beta1 += weight*betas[0]*svmask
+        fore_beta2 += weight*betas[1] * back_fidelities
+        fore_beta3 += weight*betas[2]*gamma * pf3ip_test
         
-        support_fore *= support_theta
-        support_fore *= alpha[i]
+        support_fore *= weight
         fore_potential += support_fore
         
         #support_back = np.zeros(rtest.shape)
-        support_back = betas[0]*(1-masks[idx])
-        support_back += betas[1] * get_minus_log_prob_pixels(qtest,fore_hists[i])
-        support_back += betas[2] * pb3ip_test * gammas[i]
+        support_back = betas[0]*(1-svmask)
+        support_back += betas[1] * fore_fidelities
+        support_back += betas[2] * gamma * pb3ip_test
         
-        fore_beta1 -= alpha[i]*support_theta*betas[0]*(1-masks[idx])
-        fore_beta2 -= alpha[i]*support_theta*betas[1] * get_minus_log_prob_pixels(qtest,fore_hists[i])
-        fore_beta3 -= alpha[i]*support_theta*betas[2] * pb3ip_test * gammas[i]
+        fore_beta1 -= weight*betas[0]*(1-svmask)
+        fore_beta2 -= weight*betas[1] * fore_fidelities
+        fore_beta3 -= weight*betas[2]*gamma * pb3ip_test
         
-        support_back *= support_theta
-        support_back *= alpha[i]
+        support_back *= weight
         back_potential += support_back
         
     #now compute foreground potentials
@@ -425,104 +864,616 @@ def get_unary_potentials(testimg,rimages,qimages,imfeatures,masks,global_forehis
 def pixelwise_norms(image):
     return np.sqrt(image[:,:,0]**2 + image[:,:,1]**2 + image[:,:,2]**2)
     
-def avg_pixel_difference(rimage):
-    right_diffs = rimage[:,1:,:] - rimage[:,:-1,:]
-    right_dists = pixelwise_norms(right_diffs)
-    
-    bottom_diffs = rimage[1:,:,:] - rimage[:-1,:,:]
-    bottom_dists = pixelwise_norms(bottom_diffs)
-    
-    bottomright_diffs = rimage[1:,1:,:] - rimage[:-1,:-1,:]
-    bottomright_dists = pixelwise_norms(bottomright_diffs)
+#colour distance from each pixel to its right, bottom and bottom-right neighbour
+#computed in float, uint8 differences would wrap around
+def get_neighbour_dists(rimage):
+    image = rimage.astype('float64')
+    right_dists = pixelwise_norms(image[:,1:,:] - image[:,:-1,:])
+    bottom_dists = pixelwise_norms(image[1:,:,:] - image[:-1,:,:])
+    bottomright_dists = pixelwise_norms(image[1:,1:,:] - image[:-1,:-1,:])
+    return right_dists,bottom_dists,bottomright_dists
+    
+def avg_pixel_difference(rimage,dists=None):
+    if dists is None:
+        dists = get_neighbour_dists(rimage)
+    return sum(np.sum(d) for d in dists)/float(sum(d.size for d in dists))
+    
+#Grid graph engine
+#the edge structures and weight buffers are built once per image shape. PyMaxflow
+#can't change an n-edge once it is added, so instead the last cache_size graph cuts
+#in this process are kept, and cutting with the reuse_key of one of them (same image
+#and lambda, so the same edges) only adds the change in t-edges and resolves from
+#its previous flow
+_grid_templates = {}
+_last_cuts = OrderedDict()
+
+def get_grid_template(shape):
+    if shape not in _grid_templates:
+        rows,cols = shape
+        structures = []
+        for r,c in [(1,2),(2,1),(2,2)]:
+            structure = np.zeros((3,3))
+            structure[r,c] = 1
+            structures.append(structure)
+        _grid_templates[shape] = {'structures':structures,\
+                'weights':[np.zeros(shape) for s in structures],\
+                'n_edges':rows*(cols-1) + (rows-1)*cols + (rows-1)*(cols-1)}
+    return _grid_templates[shape]
+    
+#a graph cached under reuse_key is only reused when rimage gives it the same smoothing
+#edges, with stale_edges=True it is reused regardless and keeps its old edges
+def get_argmax_image(rimage,fore_potential,back_potential,lambda_coef,reuse_key=None,cache_size=1,\
+                    stale_edges=False):
+    #maxflow.Graph[float] works in float64
+    #only back-fore matters to the cut, and its sign says which t-edge carries it
+    net = back_potential.astype('float64') - fore_potential.astype('float64')
+    template = get_grid_template(net.shape)
+    
+    weights = None
+    last_cut = _last_cuts.pop(reuse_key,None) if reuse_key is not None else None
+    if last_cut is not None and not stale_edges:
+        weights = get_edge_weights(rimage,lambda_coef,template['weights'])
+        if not all(np.array_equal(w,last_w) for w,last_w in zip(weights,last_cut[3])):
+            last_cut = None
+            
+    if last_cut is not None:
+        graph,nodeids,last_net,weights = last_cut
+        delta = net - last_net
+        graph.add_grid_tedges(nodeids,np.maximum(delta,0),np.maximum(-delta,0))
+        graph.mark_grid_nodes(nodeids)
+        graph.maxflow(reuse_trees=True)
+    else:
+        if weights is None:
+            weights = get_edge_weights(rimage,lambda_coef,template['weights'])
+        graph = maxflow.Graph[float](net.size,template['n_edges'])
+        nodeids = graph.add_grid_nodes(net.shape)
+        graph.add_grid_tedges(nodeids,np.maximum(net,0),np.maximum(-net,0))
+        add_smoothing_edges(graph,nodeids,weights)
+        graph.maxflow()
+        if reuse_key is not None:
+            #the template's maps are overwritten by the next call
+            weights = [w.copy() for w in weights]
+        
+    if reuse_key is not None:
+        _last_cuts[reuse_key] = (graph,nodeids,net,weights)
+        while len(_last_cuts) > cache_size:
+            _last_cuts.popitem(last=False)
+    return graph.get_grid_segments(nodeids)
+    
+def solve_grid_cut(fore_potential,back_potential,weights):
+    graph = maxflow.Graph[float](fore_potential.size,get_grid_template(fore_potential.shape)['n_edges'])
+    nodeids = graph.add_grid_nodes(fore_potential.shape)
+    #first add the unary potentials    
+    #maxflow.Graph[float] works in float64
+    graph.add_grid_tedges(nodeids,back_potential.astype('float64'),fore_potential.astype('float64'))
+    add_smoothing_edges(graph,nodeids,weights)
     
-    all_dists = np.hstack((right_dists.flat,bottom_dists.flat,bottomright_dists.flat))
-    return np.mean(all_dists)
+    #now get the solution!    
+    graph.maxflow()
+    # Get the segments of the nodes in the grid.
+    sgm = graph.get_grid_segments(nodeids)
+    return sgm
     
+#the edgewise smoothing potentials, as right, bottom and bottom-right weight maps
+#each is the size of the image, zero where the edge would leave it
+#out is three such maps to fill in place, their borders must already be zero
+def get_edge_weights(rimage,lambda_coef,out=None):
+    dists = get_neighbour_dists(rimage)
+    sigma = avg_pixel_difference(rimage,dists)
+    scale = -1/(2*sigma*sigma)
     
-def get_argmax_image(rimage,fore_potential,back_potential,lambda_coef):
-    graph = maxflow.Graph[float]()
-    nodeids = graph.add_grid_nodes((rimage.shape[0],rimage.shape[1]))
-    #first add the unary potentials    
-    graph.add_grid_tedges(nodeids,back_potential,fore_potential)
-    
-    sigma = avg_pixel_difference(rimage)
-    #now add the edgewise smoothing potentials    
+    if out is None:
+        out = [np.zeros((rimage.shape[0],rimage.shape[1])) for d in dists]
+    right,bottom,bottomright = out
     
     #first, right pointing edges
-    structure = np.zeros((3,3))
-    structure[1,2] = 1
-    weights = np.zeros((rimage.shape[0],rimage.shape[1]))
-    rightdists = pixelwise_norms(rimage[:,1:,:] - rimage[:,:-1,:])
-    weights[:,:-1] = lambda_coef * np.exp(-rightdists/(2*sigma*sigma))
-    graph.add_grid_edges(nodeids, structure=structure, weights=weights)
+    np.exp(dists[0]*scale,out=right[:,:-1])
+    right[:,:-1] *= lambda_coef
     
     #now, bottom pointing edges
-    structure = np.zeros((3,3))
-    structure[2,1] = 1
-    weights = np.zeros((rimage.shape[0],rimage.shape[1]))
-    bottomdists = pixelwise_norms(rimage[1:,:,:] - rimage[:-1,:,:])
-    weights[:-1,:] =  lambda_coef * np.exp(-bottomdists/(2*sigma*sigma))
-    graph.add_grid_edges(nodeids, structure=structure, weights=weights)
+    np.exp(dists[1]*scale,out=bottom[:-1,:])
+    bottom[:-1,:] *= lambda_coef
     
     #finally, bottom-right pointing edges
-    structure = np.zeros((3,3))
-    structure[2,2] = 1
-    weights = np.zeros((rimage.shape[0],rimage.shape[1]))
-    bottomrightdists = pixelwise_norms(rimage[1:,1:,:] - rimage[:-1,:-1,:])
-    weights[:-1,:-1] =  lambda_coef * (1/np.sqrt(2))*np.exp(-bottomrightdists/(2*sigma*sigma))
-    graph.add_grid_edges(nodeids, structure=structure, weights=weights)
+    np.exp(dists[2]*scale,out=bottomright[:-1,:-1])
+    bottomright[:-1,:-1] *= lambda_coef * (1/np.sqrt(2))
+    
+    return right,bottom,bottomright
+    
+def add_smoothing_edges(graph,nodeids,weights):
+    structures = get_grid_template(nodeids.shape)['structures']
+    for structure,w in zip(structures,weights):
+        graph.add_grid_edges(nodeids, structure=structure, weights=w)
+    
+#energy of a labelling, the quantity the graph cut minimizes
+#a pixel labelled True (sink side) pays its back potential, False its fore potential.
+#add_grid_edges adds directed edges, each pointing right, down or down-right, and
+#an edge is only cut, paying its weight, when its tail is False and its head True
+def get_cut_energy(labels,fore_potential,back_potential,weights):
+    right,bottom,bottomright = weights
+    source = np.logical_not(labels)
+    energy = np.sum(np.where(labels,back_potential,fore_potential))
+    energy += np.sum(right[:,:-1]*(source[:,:-1] & labels[:,1:]))
+    energy += np.sum(bottom[:-1,:]*(source[:-1,:] & labels[1:,:]))
+    energy += np.sum(bottomright[:-1,:-1]*(source[:-1,:-1] & labels[1:,1:]))
+    return energy
+    
+#Parallel graph cut, for large images, by dual decomposition
+#the grid is split into horizontal strips, consecutive strips sharing one row.
+#each edge belongs to one strip, and the unary terms and right edges of a shared
+#row are split in half between its two strips. every round all the strips are cut
+#concurrently, with a multiplier per shared pixel added to its True cost in the
+#strip above and taken off in the strip below. where the two strips disagree the
+#multiplier moves to penalize the disagreement, and its step halves whenever the
+#disagreement flips. once every shared row agrees the joined labelling is a
+#minimum cut of the whole grid, and if that takes more than max_rounds the whole
+#grid is cut in one go instead.
+#each strip's graph is built once, in the worker process that keeps it for the whole
+#cut. later rounds only send it the change in its multipliers, which it adds to the
+#t-edges of its shared rows before resolving from the previous flow, and it only
+#sends back those rows until the strips agree
+
+#rows r0..r1 (inclusive) of every strip
+def get_strip_bounds(rows,n_strips):
+    n_strips = max(min(n_strips,rows-1),1)
+    cuts = [int(round(k*(rows-1)/float(n_strips))) for k in range(n_strips+1)]
+    return zip(cuts[:-1],cuts[1:])
+    
+#net (back-fore) and edge weights of the strip of rows r0..r1, without multipliers
+def get_strip_problem(net,weights,r0,r1):
+    snet = net[r0:r1+1].copy()
+    sweights = [w[r0:r1+1].copy() for w in weights]
+    #edges leaving the last row belong to the strip below
+    sweights[1][-1] = 0
+    sweights[2][-1] = 0
+    if r0 > 0:
+        snet[0] *= .5
+        sweights[0][0] *= .5
+    if r1 < net.shape[0]-1:
+        snet[-1] *= .5
+        sweights[0][-1] *= .5
+    return snet,sweights
+    
+#messages to a strip: ('build',snet,sweights) builds and cuts its graph,
+#('update',first_delta,last_delta) adds to the net of its first and last rows (either
+#may be None) and resolves, both answer with those two rows of its labels.
+#('labels',) answers with all of them
+def handle_strip_message(strip,msg):
+    if msg[0] == 'build':
+        _,snet,sweights = msg
+        graph = maxflow.Graph[float](snet.size,get_grid_template(snet.shape)['n_edges'])
+        nodeids = graph.add_grid_nodes(snet.shape)
+        graph.add_grid_tedges(nodeids,np.maximum(snet,0),np.maximum(-snet,0))
+        add_smoothing_edges(graph,nodeids,sweights)
+        graph.maxflow()
+        strip['graph'],strip['nodeids'] = graph,nodeids
+    elif msg[0] == 'update':
+        graph,nodeids = strip['graph'],strip['nodeids']
+        for row,delta in [(0,msg[1]),(-1,msg[2])]:
+            if delta is not None:
+                graph.add_grid_tedges(nodeids[row],np.maximum(delta,0),np.maximum(-delta,0))
+                graph.mark_grid_nodes(nodeids[row])
+        graph.maxflow(reuse_trees=True)
+        
+    labels = strip['graph'].get_grid_segments(strip['nodeids'])
+    if msg[0] == 'labels':
+        return labels
+    return labels[0],labels[-1]
+    
+#keeps the strips it is sent, by strip number, until told to stop with None
+def run_cut_worker(conn):
+    strips = {}
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        k = msg[0]
+        conn.send(handle_strip_message(strips.setdefault(k,{}),msg[1:]))
+    conn.close()
+    
+#n_workers processes for get_argmax_image_parallel, each a (connection,process)
+def start_cut_workers(n_workers):
+    workers = []
+    for p in range(n_workers):
+        conn,worker_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=run_cut_worker,args=(worker_conn,))
+        proc.daemon = True
+        proc.start()
+        workers.append((conn,proc))
+    return workers
     
-    #now get the solution!    
-    graph.maxflow()
-    # Get the segments of the nodes in the grid.
-    sgm = graph.get_grid_segments(nodeids)
-    return sgm
+def stop_cut_workers(workers):
+    for conn,proc in workers or []:
+        conn.send(None)
+    for conn,proc in workers or []:
+        proc.join()
+        
+#msgs[k] goes to strip k, which lives in worker k % len(workers), or here in strips
+#without workers. a worker is only sent its next message once it has answered
+def send_strip_messages(workers,strips,msgs):
+    if workers is None:
+        return [handle_strip_message(strips.setdefault(k,{}),msg) for k,msg in enumerate(msgs)]
+    replies = [None]*len(msgs)
+    for start in range(0,len(msgs),len(workers)):
+        wave = range(start,min(start+len(workers),len(msgs)))
+        for k in wave:
+            workers[k % len(workers)][0].send((k,)+msgs[k])
+        for k in wave:
+            replies[k] = workers[k % len(workers)][0].recv()
+    return replies
+    
+#workers come from start_cut_workers (or None to run here), n_strips is best their number
+#returns the labels and the number of rounds, 0 if the strips never agreed
+def get_argmax_image_parallel(rimage,fore_potential,back_potential,lambda_coef,workers,n_strips,\
+                                max_rounds=50):
+    weights = get_edge_weights(rimage,lambda_coef)
+    net = back_potential.astype('float64') - fore_potential.astype('float64')
+    bounds = get_strip_bounds(net.shape[0],n_strips)
+    strips = {}
+    msgs = [('build',)+get_strip_problem(net,weights,r0,r1) for r0,r1 in bounds]
+    
+    #one multiplier step and last disagreement per pixel of each shared row
+    cols = net.shape[1]
+    steps = [np.ones(cols)*.5*np.mean(np.abs(net)) for b in bounds[1:]]
+    last_diffs = [np.zeros(cols) for b in bounds[1:]]
+    
+    for n_round in range(max_rounds):
+        #first and last row labels of every strip
+        edge_rows = send_strip_messages(workers,strips,msgs)
+        
+        agree = True
+        deltas = []
+        for k in range(len(steps)):
+            diff = edge_rows[k][1].astype('float64') - edge_rows[k+1][0]
+            if np.any(diff):
+                agree = False
+            steps[k][diff*last_diffs[k] < 0] *= .5
+            deltas.append(steps[k]*diff)
+            last_diffs[k][diff != 0] = diff[diff != 0]
+            
+        if agree:
+            strip_labels = send_strip_messages(workers,strips,[('labels',)]*len(bounds))
+            labels = np.empty(net.shape,'bool')
+            for k,(r0,r1) in enumerate(bounds):
+                labels[r0:r1+1] = strip_labels[k]
+            return labels,n_round+1
+            
+        #the multiplier is added to the strip above's True cost and taken off the strip below's
+        msgs = [('update',-deltas[k-1] if k > 0 else None,deltas[k] if k < len(deltas) else None)\
+                    for k in range(len(bounds))]
+            
+    print "Strips did not agree after",max_rounds,"rounds, cutting the whole grid"
+    return solve_grid_cut(np.maximum(-net,0),np.maximum(net,0),weights),0
+    
+#whether a labelling matches the single graph cut, and how much higher its energy is
+def check_parallel_cut(rimage,fore_potential,back_potential,lambda_coef,labels):
+    weights = get_edge_weights(rimage,lambda_coef)
+    sequential = solve_grid_cut(fore_potential,back_potential,weights)
+    energy_gap = get_cut_energy(labels,fore_potential,back_potential,weights) - \
+                    get_cut_energy(sequential,fore_potential,back_potential,weights)
+    return np.all(labels == sequential),energy_gap
+    
+#time the single graph cut against get_argmax_image_parallel with each number of cores
+def benchmark_parallel_cut(rimage,fore_potential,back_potential,lambda_coef,core_counts=(1,2,4,8)):
+    start = time.time()
+    get_argmax_image(rimage,fore_potential,back_potential,lambda_coef)
+    seq_time = time.time()-start
+    print "Single graph cut took",seq_time,"s"
+    
+    report = []
+    for n_cores in core_counts:
+        workers = start_cut_workers(n_cores)
+        start = time.time()
+        labels,n_rounds = get_argmax_image_parallel(rimage,fore_potential,back_potential,lambda_coef,\
+                                workers,n_cores)
+        elapsed = time.time()-start
+        stop_cut_workers(workers)
+        
+        same,energy_gap = check_parallel_cut(rimage,fore_potential,back_potential,lambda_coef,labels)
+        report.append((n_cores,elapsed,seq_time/elapsed,n_rounds,same,energy_gap))
+        print n_cores,"cores took",elapsed,"s in",n_rounds,"rounds, a speedup of",seq_time/elapsed
+        print "    matches single graph cut:",same,"energy gap",energy_gap
+    return report
+    
+#benchmark_parallel_cut on the full size image of the pennfudan image after the
+#first n_images, with the global histogram terms of those as unary potentials,
+#written to cut_benchmark_<time>/results.txt
+#python experiment.py cut_benchmark runs it
+def benchmark_parallel_cuts(n_images=40,lambda_coef=1.0,core_counts=(1,2,4,8)):
+    qbins = 20
+    totalbins = int(qbins**3)
+    impaths,maskpaths = get_image_paths('pennfudan')
+    rimages,masks,_ = load_images('pennfudan',n_images,impaths,maskpaths)
+    qimages = get_quantized_images(rimages,qbins,'pennfudan')
+    fore_global_hist,back_global_hist = get_global_histograms(qimages,masks,totalbins)
+    
+    image = cv2.imread(impaths[n_images])
+    qimage = get_quantized_image(image,qbins,'pennfudan')
+    fore_potential = get_minus_log_prob_pixels(qimage,back_global_hist)
+    back_potential = get_minus_log_prob_pixels(qimage,fore_global_hist)
+    print "Cutting a",image.shape[0],"by",image.shape[1],"image"
+    report = benchmark_parallel_cut(image,fore_potential,back_potential,lambda_coef,core_counts)
+    
+    bench_dir = 'cut_benchmark_' + str(int(time.time()))
+    os.mkdir(bench_dir)
+    log_f = open(os.path.join(bench_dir,'results.txt'),'w')
+    log_f.write("{0} by {1} image, {2} cpus available\n".format(image.shape[0],image.shape[1],\
+                    multiprocessing.cpu_count()))
+    for n_cores,elapsed,speedup,n_rounds,same,energy_gap in report:
+        log_f.write("{0} cores took {1}s in {2} rounds, a speedup of {3}\n".format(n_cores,elapsed,\
+                        n_rounds,speedup))
+        log_f.write("    matches single graph cut: {0}, energy gap {1}\n".format(same,energy_gap))
+    log_f.close()
+    return report
     
-def measure_fg_accuracy(mask,realmask):
+#pixel counts behind every accuracy measure, so that accuracies can be
+#aggregated as results stream back without shipping the masks around
+#[same label, labeled, both object, either object (within labeled),
+# both foreground, either foreground, both background, either background]
+def get_accuracy_counts(mask,realmask,labeled):
     both_fg = np.logical_and(mask,realmask)
-    #Uses Pascal VOC criteria for accuracy
-    return float(np.sum(both_fg))/np.sum(np.logical_or(mask,realmask))
+    either_fg = np.logical_or(mask,realmask)
     
-def measure_bg_accuracy(mask,realmask):
     maskbg = np.logical_not(mask)
     realbg = np.logical_not(realmask)
+    both_bg = np.logical_and(maskbg,realbg)
+    either_bg = np.logical_or(maskbg,realbg)
     
-    bothbg = np.logical_and(maskbg,realbg)
-    return float(np.sum(bothbg))/np.sum(np.logical_or(maskbg,realbg))
-    
-def measure_sa_accuracy(mask,realmask,labeled):
     same_in_label = np.logical_and(labeled, mask==realmask)
-    return float(np.sum(same_in_label))/np.sum(labeled)
+    both_obj = np.logical_and(labeled,both_fg)
+    either_obj = np.logical_and(labeled,either_fg)
+    
+    return np.array([np.sum(same_in_label),np.sum(labeled),\
+                     np.sum(both_obj),np.sum(either_obj),\
+                     np.sum(both_fg),np.sum(either_fg),\
+                     np.sum(both_bg),np.sum(either_bg)])
     
-def measure_so_accuracy(mask,realmask,labeled):
-    both_obj = np.logical_and(labeled,np.logical_and(mask==1,realmask==1))
-    either_obj = np.logical_and(labeled, np.logical_or(mask==1,realmask==1))
-    return float(np.sum(both_obj))/np.sum(either_obj)
+def measure_fg_accuracy(counts):
+    #Uses Pascal VOC criteria for accuracy
+    return float(counts[4])/counts[5]
+    
+def measure_bg_accuracy(counts):
+    return float(counts[6])/counts[7]
+    
+def measure_sa_accuracy(counts):
+    return float(counts[0])/counts[1]
+    
+def measure_so_accuracy(counts):
+    return float(counts[2])/counts[3]
+    
+#s_a, s_o, fg and bg accuracy of one image from get_accuracy_counts
+def accuracies_from_counts(counts):
+    return measure_sa_accuracy(counts),measure_so_accuracy(counts),\
+            measure_fg_accuracy(counts),measure_bg_accuracy(counts)
+    
+#validation accuracy given by average of s_o and s_a
+def validation_accuracy(imtype,a_acc,o_acc,fg_acc,bg_acc):
+    if imtype=='pennfudan':
+        return (fg_acc+bg_acc)/2.0 #optimize fg/bg accuracy for penn-fudan
+    return (a_acc+o_acc)/2.0
+    
+#training data shared by every evaluation worker
+#sent once per process by the pool initializer, not once per test image
+_eval_state = {}
+
+#sv_tol > 0 prunes support vectors with alpha*theta below it through build_sv_index
+def get_eval_state(rimages,qimages,imfeatures,masks,fore_global_hist,back_global_hist,\
+                    qbins,totalbins,sigma,imtype,dtype='float64',sv_tol=0,bin_map=None):
+    return {'rimages':rimages,'qimages':qimages,'imfeatures':imfeatures,'masks':masks,\
+            'fore_global_hist':fore_global_hist,'back_global_hist':back_global_hist,\
+            'qbins':qbins,'totalbins':totalbins,'sigma':sigma,'imtype':imtype,'dtype':dtype,\
+            'sv_tol':sv_tol,'bin_map':bin_map}
+    
+def init_eval_worker(state):
+    _eval_state.clear()
+    _eval_state.update(state)
+    #per config index, the support vector index (if pruning) and gammas
+    _eval_state['models'] = {}
+    _last_cuts.clear()
+    
+def get_eval_model(config_idx,alpha,support_vecs):
+    s = _eval_state
+    if config_idx not in s['models']:
+        sv_index = None
+        if s['sv_tol'] > 0:
+            sv_index = build_sv_index(s['imfeatures'],support_vecs,alpha,s['sigma'])
+        dense_bins = len(s['bin_map']) if s['bin_map'] is not None else None
+        gammas = get_support_gammas(s['qimages'],s['masks'],support_vecs,\
+                    s['fore_global_hist'],s['back_global_hist'],s['dtype'],dense_bins)
+        s['models'][config_idx] = (sv_index,gammas)
+    return s['models'][config_idx]
+    
+#segment one test image
+#task is (config index, image index, image, mask, labels, betas, lambda, alpha,
+#support vectors, whether to send back the potential maps for display)
+#dropped is the fraction of alpha*theta mass left out by pruning
+def evaluate_test_image(task):
+    config_idx,i,testimg,testmask,testlabel,betas,lambda_coef,alpha,support_vecs,keep_maps,keep_amax = task
+    s = _eval_state
+    sv_index,gammas = get_eval_model(config_idx,alpha,support_vecs)
+    
+    newsize = (s['qimages'][0].shape[1],s['qimages'][0].shape[0])
+    rtest = cv2.resize(testimg,newsize)
+    feattest = get_image_feature(rtest,s['imtype'])
+    
+    dropped,thetas,closest = 0.,None,None
+    if sv_index is not None:
+        selected,closest,dropped,thetas = query_sv_index(sv_index,feattest,s['sv_tol'])
+        closest = support_vecs[closest]
+        alpha,support_vecs,gammas = alpha[selected],support_vecs[selected],gammas[selected]
+    
+    fore,back,b1,b2,b3,bt1,bt2 = get_unary_potentials(testimg,s['rimages'],s['qimages'],s['imfeatures'],\
+                                    s['masks'],s['fore_global_hist'],s['back_global_hist'],\
+                                    s['qbins'],s['totalbins'],s['sigma'],s['imtype'],\
+                                    betas,alpha,support_vecs,s['dtype'],feattest,gammas,s['bin_map'],\
+                                    thetas,closest)
+    
+    #configs on the same image and lambda reuse its graph while it is still cached
+    if s.get('cut_workers') is not None:
+        amax,_ = get_argmax_image_parallel(rtest,fore,back,lambda_coef,s['cut_workers'],s['cut_strips'])
+    else:
+        amax = get_argmax_image(rtest,fore,back,lambda_coef,(i,lambda_coef),s.get('cut_cache_size',1))
+    counts = get_accuracy_counts(amax,testmask,testlabel)
+    
+    maps = None
+    if keep_maps:
+        maps = (b1,b2,b3,fore-back,bt1,bt2)
+    if not keep_amax:
+        amax = None
+    return config_idx,i,counts,amax,maps,dropped
+    
+#with a single process everything runs in this one, without a pool
+def get_eval_pool(n_procs,state):
+    if n_procs > 1:
+        return multiprocessing.Pool(n_procs,init_eval_worker,(state,))
+    init_eval_worker(state)
+    return None
+    
+#results come back in completion order, not task order
+#each worker takes chunksize consecutive tasks at a time
+def iter_eval_results(pool,tasks,chunksize=1):
+    if pool is None:
+        return itertools.imap(evaluate_test_image,tasks)
+    return pool.imap_unordered(evaluate_test_image,tasks,chunksize)
+    
+def close_eval_pool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+        
+#Sharded evaluation, for tasks submitted a few at a time while the caller keeps working
+#image i always goes to the single process pool i % n_shards, which runs its tasks in
+#submission order and caches the graphs of all its images, so that a graph built for
+#one config is reused by the next config on the same image and lambda
+#with a single process there are no shards, and tasks run as they are submitted
+def get_eval_shards(n_procs,state,n_images):
+    n_shards = max(min(n_procs,n_images),1)
+    state = dict(state,cut_cache_size=int(np.ceil(n_images/float(n_shards))))
+    if n_procs > 1:
+        return [multiprocessing.Pool(1,init_eval_worker,(state,)) for k in range(n_shards)]
+    init_eval_worker(state)
+    return None
+    
+#returns a function that waits for and returns the result of evaluate_test_image
+def submit_eval_task(shards,task):
+    if shards is None:
+        result = evaluate_test_image(task)
+        return lambda: result
+    return shards[task[1] % len(shards)].apply_async(evaluate_test_image,(task,)).get
+    
+def close_eval_shards(shards):
+    for pool in shards or []:
+        close_eval_pool(pool)
+    
+#cv2.imwrite on a background thread, so logging never holds up evaluation
+def start_image_writer():
+    write_q = WriteQueue(maxsize=64)
+    
+    def write_images():
+        while True:
+            item = write_q.get()
+            if item is None:
+                break
+            path,image = item
+            cv2.imwrite(path,image)
+            
+    writer = threading.Thread(target=write_images)
+    writer.daemon = True
+    writer.start()
+    return write_q,writer
+    
+def stop_image_writer(write_q,writer):
+    write_q.put(None)
+    writer.join()
+    
+#test image darkened outside the argmax and outside the ground truth
+def get_masked_images(rtest,amax,rtestmask):
+    rmasked = rtest.copy()
+    rmasked[amax==0]/=10
+    rgroundtruth = rtest.copy()
+    rgroundtruth[rtestmask==0]/=10
+    return rmasked,rgroundtruth
+    
+def show_test_result(rtest,rmasked,rgroundtruth,maps):
+    b1,b2,b3,fore_minus_back,bt1,bt2 = maps
+    
+    cv2.imshow('Original', rtest)
+    cv2.imshow('Argmax Masked image',rmasked)
+    cv2.imshow('Ground Truth Masked Image',rgroundtruth)
+    
+    cv2.imshow("Closest theta match",bt1)
+    cv2.imshow("Second closest theta match",bt2)
+    
+    f5 = plt.figure()
+    plt.subplot(1,6,1)
+    plt.imshow(cv2.cvtColor(rtest,cv2.COLOR_BGR2RGB))
+    plt.axis('off')
+    
+    plt.subplot(1,6,2)
+    plt.imshow(cv2.cvtColor(rmasked,cv2.COLOR_BGR2RGB))
+    plt.axis('off')
+    
+    plt.subplot(1,6,3)
+    plt.imshow(b1)
+    plt.colorbar()
+    plt.axis('off')
+    
+    plt.subplot(1,6,4)
+    plt.imshow(b2)
+    plt.colorbar()
+    plt.axis('off')
+    
+    plt.subplot(1,6,5)
+    plt.imshow(b3)
+    plt.colorbar()
+    plt.axis('off')
+    
+    plt.subplot(1,6,6)
+    plt.imshow(fore_minus_back)
+    plt.colorbar()
+    plt.axis('off')
+    
+    cv2.waitKey()
+    [plt.close(f) for f in [f5]]
 
+#n_procs test images are segmented at once, the running averages are
+#updated as each one finishes
+#with parallel_cut, images are segmented one at a time instead, each graph cut
+#split across the n_procs processes by get_argmax_image_parallel
+#along with the accuracies, returns the average bound on the fraction of potential
+#mass that sv_tol dropped (0 without pruning)
 def get_test_accuracy(testimages,testmasks,testlabels,rimages,qimages,imfeatures,masks,\
                         fore_global_hist,back_global_hist,qbins,totalbins,\
-                        sigma,lambda_coef,imtype,betas,alpha,support_vecs,interactive=False,log_dir=False):
+                        sigma,lambda_coef,imtype,betas,alpha,support_vecs,interactive=False,log_dir=False,\
+                        n_procs=1,dtype='float64',sv_tol=0,bin_map=None,parallel_cut=False):
          
     total_a_acc,total_o_acc,total_ims = 0,0,0     
     total_fg_acc,total_bg_acc=0,0
+    total_dropped = 0
     
-    for i in range(len(testimages)):
-
-        fore,back,b1,b2,b3,bt1,bt2 = get_unary_potentials(testimages[i],rimages,qimages,imfeatures,masks,fore_global_hist,\
-                                    back_global_hist,qbins,totalbins,sigma,imtype,\
-                                    betas,alpha,support_vecs)
-                                    
-        newsize = (qimages[0].shape[1],qimages[0].shape[0])
-        rtest = cv2.resize(testimages[i],newsize)
-        rtestmask = testmasks[i]
-        rtestlabeled = testlabels[i]
-        
-        amax = get_argmax_image(rtest,fore,back,lambda_coef)
-        
-        a_acc = measure_sa_accuracy(amax,rtestmask,rtestlabeled)
-        o_acc = measure_so_accuracy(amax,rtestmask,rtestlabeled)
-        fg_acc = measure_fg_accuracy(amax,rtestmask)
-        bg_acc = measure_bg_accuracy(amax,rtestmask)
+    state = get_eval_state(rimages,qimages,imfeatures,masks,fore_global_hist,back_global_hist,\
+                            qbins,totalbins,sigma,imtype,dtype,sv_tol,bin_map)
+    keep_amax = bool(interactive or log_dir)
+    tasks = [(0,i,testimages[i],testmasks[i],testlabels[i],betas,lambda_coef,alpha,support_vecs,\
+                interactive,keep_amax) for i in range(len(testimages))]
+    
+    if parallel_cut:
+        pool = get_eval_pool(1,state)
+        _eval_state.update(cut_workers=start_cut_workers(n_procs),cut_strips=n_procs)
+    else:
+        pool = get_eval_pool(n_procs,state)
+    if log_dir:
+        write_q,writer = start_image_writer()
+    
+    newsize = (qimages[0].shape[1],qimages[0].shape[0])
+    #what is shown waits on disk rather than in memory until every image is done
+    shown = []
+    if interactive:
+        shown_dir = tempfile.mkdtemp(dir=log_dir or None)
+    
+    for _,i,counts,amax,maps,dropped in iter_eval_results(pool,tasks):
+        a_acc,o_acc,fg_acc,bg_acc = accuracies_from_counts(counts)
+        total_dropped += dropped
                 
         total_a_acc += a_acc
         total_o_acc += o_acc
@@ -540,100 +1491,239 @@ def get_test_accuracy(testimages,testmasks,testlabels,rimages,qimages,imfeatures
             print "Average s_o accuracy is ",total_o_acc/total_ims
             print "Average bg accuracy is ",total_bg_acc/total_ims
             print "Average fg accuracy is ",total_fg_acc/total_ims
+            if sv_tol > 0:
+                print "Fraction of potential mass dropped is at most",dropped
         
-            rmasked = rtest.copy()
-            rmasked[amax==0]/=10
-            rgroundtruth = rtest.copy()
-            rgroundtruth[rtestmask==0]/=10
+            rtest = cv2.resize(testimages[i],newsize)
+            rmasked,rgroundtruth = get_masked_images(rtest,amax,testmasks[i])
             
             if interactive:
-                
-                """f1 = plt.figure()
-                plt.imshow(fore-back)
-                plt.colorbar()
-                
-                f2 = plt.figure()
-                plt.imshow(b1)
-                plt.colorbar()
-                
-                f3 = plt.figure()
-                plt.imshow(b2)
-                plt.colorbar()
-                
-                f4 = plt.figure()
-                plt.imshow(b3)
-                plt.colorbar()"""
-                
-                cv2.imshow('Original', rtest)
-                cv2.imshow('Argmax Masked image',rmasked)
-                cv2.imshow('Ground Truth Masked Image',rgroundtruth)
-                
-                cv2.imshow("Closest theta match",bt1)
-                cv2.imshow("Second closest theta match",bt2)
-                
-                f5 = plt.figure()
-                plt.subplot(1,6,1)
-                plt.imshow(cv2.cvtColor(rtest,cv2.COLOR_BGR2RGB))
-                plt.axis('off')
-                
-                plt.subplot(1,6,2)
-                plt.imshow(cv2.cvtColor(rmasked,cv2.COLOR_BGR2RGB))
-                plt.axis('off')
-                
-                plt.subplot(1,6,3)
-                plt.imshow(b1)
-                plt.colorbar()
-                plt.axis('off')
-                
-                plt.subplot(1,6,4)
-                plt.imshow(b2)
-                plt.colorbar()
-                plt.axis('off')
-                
-                plt.subplot(1,6,5)
-                plt.imshow(b3)
-                plt.colorbar()
-                plt.axis('off')
-                
-                plt.subplot(1,6,6)
-                plt.imshow(fore-back)
-                plt.colorbar()
-                plt.axis('off')
-                
-                cv2.waitKey()
-                [plt.close(f) for f in [f5]]
+                shown_path = os.path.join(shown_dir,'shown{0}.npz'.format(i))
+                np.savez(shown_path,rtest,rmasked,rgroundtruth,*maps)
+                shown.append(shown_path)
                 
             if log_dir:
-                cv2.imwrite(os.path.join(log_dir,'test_amax{0}.png'.format(i)),rmasked)
-                cv2.imwrite(os.path.join(log_dir,'test_truth{0}.png'.format(i)),rgroundtruth)
+                write_q.put((os.path.join(log_dir,'test_amax{0}.png'.format(i)),rmasked))
+                write_q.put((os.path.join(log_dir,'test_truth{0}.png'.format(i)),rgroundtruth))
             
+    close_eval_pool(pool)
+    stop_cut_workers(_eval_state.pop('cut_workers',None))
+    if log_dir:
+        stop_image_writer(write_q,writer)
+    
+    #only displayed once every image is done, waiting on a keypress
+    #would otherwise stall the evaluation
+    for shown_path in shown:
+        item = np.load(shown_path)
+        rtest,rmasked,rgroundtruth = item['arr_0'],item['arr_1'],item['arr_2']
+        maps = [item['arr_{0}'.format(k)] for k in range(3,9)]
+        item.close()
+        os.remove(shown_path)
+        show_test_result(rtest,rmasked,rgroundtruth,maps)
+    if interactive:
+        os.rmdir(shown_dir)
             
     avg_a_acc = total_a_acc/total_ims
     avg_o_acc = total_o_acc/total_ims
     avg_fg_acc = total_fg_acc/total_ims
     avg_bg_acc = total_bg_acc/total_ims
+    avg_dropped = total_dropped/total_ims
+    if sv_tol > 0:
+        print "Average fraction of potential mass dropped is at most",avg_dropped
     
-    return avg_a_acc,avg_o_acc,avg_fg_acc,avg_bg_acc
+    return avg_a_acc,avg_o_acc,avg_fg_acc,avg_bg_acc,avg_dropped
     
-def get_test_accuracy_worker(testimages,testmasks,testlabels,rimages,qimages,imfeatures,masks,\
-                        fore_global_hist,back_global_hist,qbins,totalbins,\
-                        sigma,lambda_coef,imtype,betas,alpha,support_vecs,queue):
-                            
-    a_acc,o_acc,fg_acc,bg_acc = get_test_accuracy(testimages,testmasks,testlabels,rimages,qimages,imfeatures,masks,\
-                        fore_global_hist,back_global_hist,qbins,totalbins,\
-                        sigma,lambda_coef,imtype,betas,alpha,support_vecs)
-    #validation accuracy given by average of s_o and s_a
-    if imtype=='pennfudan':
-        accuracy = (fg_acc+bg_acc)/2.0 #optimize fg/bg accuracy for penn-fudan
+
+#Stream segmentation, for consecutive frames of one scene
+#source is a video file or camera index for cv2.VideoCapture,
+#or a directory or list of image files read in sorted order
+#files cv2 can't read as images, such as stray non-image files in the directory, are skipped
+def iter_stream_frames(source):
+    if isinstance(source,basestring) and os.path.isdir(source):
+        source = [os.path.join(source,f) for f in sorted(os.listdir(source))]
+        
+    if isinstance(source,list):
+        for f in source:
+            frame = cv2.imread(f)
+            if frame is None:
+                print "Skipping",f,"which is not a readable image"
+                continue
+            yield frame
+    else:
+        capture = cv2.VideoCapture(source)
+        while True:
+            ok,frame = capture.read()
+            if not ok:
+                break
+            yield frame
+        capture.release()
+        
+#the support vectors are ranked by alpha*theta on an anchor frame, and later frames
+#only use the top_k of them until their HOG features drift more than drift_tol
+#(relative to the anchor) from it. every frame gets its own smoothing edges, and the
+#previous frame's graph is only resolved from its flow when they are the same.
+#stale_edges=True reuses the graph across a whole anchor's frames anyway, keeping the
+#anchor frame's edges, which is faster but only approximates the later frames' cuts
+#returns the sustained frames per second
+def segment_stream(source,rimages,qimages,imfeatures,masks,fore_global_hist,back_global_hist,\
+                    qbins,totalbins,sigma,lambda_coef,imtype,betas,alpha,support_vecs,\
+                    top_k=20,drift_tol=0.1,dtype='float64',interactive=False,out_dir=None,bin_map=None,\
+                    stale_edges=False):
+                        
+    newsize = (qimages[0].shape[1],qimages[0].shape[0])
+    support_vecs = np.asarray(support_vecs)
+    svfeatures = [imfeatures[idx] for idx in support_vecs]
+    dense_bins = len(bin_map) if bin_map is not None else None
+    gammas = get_support_gammas(qimages,masks,support_vecs,fore_global_hist,back_global_hist,dtype,dense_bins)
+    
+    if out_dir:
+        write_q,writer = start_image_writer()
+        
+    #a graph left by an earlier stream would match ('stream',1)
+    _last_cuts.clear()
+    anchor_feat = None
+    n_frames,n_anchors = 0,0
+    start = time.time()
+    
+    for frame in iter_stream_frames(source):
+        rframe = cv2.resize(frame,newsize)
+        feat = get_image_feature(rframe,imtype)
+        
+        if anchor_feat is None or \
+                np.linalg.norm(feat-anchor_feat) > drift_tol*np.linalg.norm(anchor_feat):
+            anchor_feat = feat
+            weights = alpha*get_thetas(feat,svfeatures,sigma)
+            candidates = np.argsort(weights)[::-1][:max(top_k,2)]
+            n_anchors += 1
+            
+        fore,back,_,_,_,_,_ = get_unary_potentials(rframe,rimages,qimages,imfeatures,masks,fore_global_hist,\
+                                    back_global_hist,qbins,totalbins,sigma,imtype,\
+                                    betas,alpha[candidates],support_vecs[candidates],dtype,\
+                                    feat,gammas[candidates],bin_map)
+        #later frames of an anchor only change the t-edges of its graph, when their edges match
+        amax = get_argmax_image(rframe,fore,back,lambda_coef,('stream',n_anchors),1,stale_edges)
+        
+        rmasked = rframe.copy()
+        rmasked[amax==0]/=10
+        if interactive:
+            cv2.imshow('Stream segmentation',rmasked)
+            cv2.waitKey(1)
+        if out_dir:
+            write_q.put((os.path.join(out_dir,'frame{0}.png'.format(n_frames)),rmasked))
+        n_frames += 1
+        
+    fps = n_frames/(time.time()-start)
+    if out_dir:
+        stop_image_writer(write_q,writer)
+        
+    print "Segmented",n_frames,"frames at",fps,"frames per second"
+    print "Support vectors were reranked on",n_anchors,"frames"
+    return fps
+    
+#One class SVM on a precomputed gram, solving the same dual as libsvm
+#   min 1/2 a'Ga  subject to 0 <= a_i <= 1, sum(a) = nu*n
+#by SMO on the maximal violating pair, stopping at the same tol as libsvm.
+#unlike libsvm it reads the caller's gram buffer instead of copying it into its
+#own cache, and can warm start from another config's alphas
+def init_one_class_alpha(n_images,nu,alpha0=None):
+    target = nu*n_images
+    if alpha0 is None:
+        #libsvm's starting point, the first nu*n alphas at 1
+        alpha = np.zeros(n_images)
+        n_full = int(target)
+        alpha[:n_full] = 1
+        if n_full < n_images:
+            alpha[n_full] = target-n_full
+        return alpha
+        
+    #scale onto the new sum, then spread whatever clipping lost over the alphas below 1
+    alpha = np.clip(alpha0*(target/alpha0.sum()),0,1)
+    while target-alpha.sum() > 1e-12:
+        room = 1-alpha
+        free = room > 0
+        alpha[free] += np.minimum(room[free],(target-alpha.sum())/np.sum(free))
+    return alpha
+    
+#returns all n alphas (zero off the support vectors), rho and the number of iterations
+def fit_one_class_svm(gram,nu,alpha0=None,tol=1e-3,max_iter=1000000):
+    n_images = gram.shape[0]
+    alpha = init_one_class_alpha(n_images,nu,alpha0)
+    #omega2 makes the gram asymmetric, libsvm builds the gradient from its rows
+    grad = alpha.dot(gram)
+    diag = np.diag(gram).copy()
+    
+    for n_iter in xrange(max_iter):
+        #i can grow, j can shrink
+        #stops with no violating pair, and when no alpha can grow (nu = 1) or shrink
+        up = np.where(alpha < 1,grad,np.inf)
+        down = np.where(alpha > 0,grad,-np.inf)
+        i,j = np.argmin(up),np.argmax(down)
+        if down[j]-up[i] < tol:
+            break
+            
+        quad = max(diag[i]+diag[j]-2*gram[i,j],1e-12)
+        step = min((grad[j]-grad[i])/quad,1-alpha[i],alpha[j])
+        alpha[i] += step
+        alpha[j] -= step
+        grad += step*(gram[i]-gram[j])
+        
+    #rho as libsvm computes it, the mean gradient over the free alphas,
+    #or without any, midway between the bounds the alphas at 0 and 1 give
+    free = np.logical_and(alpha > 0,alpha < 1)
+    if np.any(free):
+        rho = np.mean(grad[free])
     else:
-        accuracy = (a_acc+o_acc)/2.0
-    queue.put((accuracy, o_acc,a_acc,fg_acc,bg_acc))
+        bounds = [np.max(grad[alpha > 0])] if np.any(alpha > 0) else []
+        bounds += [np.min(grad[alpha < 1])] if np.any(alpha < 1) else []
+        rho = np.mean(bounds)
+    return alpha,rho,n_iter
+    
+#alphas for every nu in nus on one gram, each warm started from the previous nu
+def fit_one_class_svm_path(gram,nus,tol=1e-3):
+    alphas = {}
+    alpha = None
+    for nu in sorted(nus):
+        alpha,_,_ = fit_one_class_svm(gram,nu,alpha,tol)
+        alphas[nu] = alpha.copy()
+    return alphas
+    
+#solver is 'sklearn' or 'warm' (fit_one_class_svm, warm started from alpha0)
+#returns alpha and support vectors as in dual_coef_ and support_, and all n alphas
+def train_one_class_svm(gram,nu,solver='sklearn',alpha0=None):
+    if solver == 'warm':
+        full_alpha,_,_ = fit_one_class_svm(gram,nu,alpha0)
+        support_vecs = np.where(full_alpha > 0)[0]
+        return full_alpha[support_vecs],support_vecs,full_alpha
+        
+    ocSVM = svm.OneClassSVM(kernel='precomputed',nu=nu)
+    ocSVM.fit(gram)
+    alpha = ocSVM.dual_coef_.flatten()
+    full_alpha = np.zeros(gram.shape[0])
+    full_alpha[ocSVM.support_] = alpha
+    return alpha,ocSVM.support_,full_alpha
+    
+#time sklearn against the warm started path over nus on one gram, and compare their alphas
+def benchmark_one_class_svm(gram,nus):
+    start = time.time()
+    sk_alphas = dict((nu,train_one_class_svm(gram,nu)[2]) for nu in nus)
+    sk_time = time.time()-start
+    
+    start = time.time()
+    warm_alphas = fit_one_class_svm_path(gram,nus)
+    warm_time = time.time()-start
+    
+    alpha_delta = max(np.max(np.abs(sk_alphas[nu]-warm_alphas[nu])) for nu in nus)
+    support_agreement = min(np.mean((sk_alphas[nu] > 0) == (warm_alphas[nu] > 0)) for nu in nus)
+    
+    print "sklearn took",sk_time,"s and the warm started path took",warm_time,"s"
+    print "Largest alpha difference is",alpha_delta,"and support vectors agree on",support_agreement
+    return sk_time,warm_time,alpha_delta,support_agreement
     
-
 def cross_validate(n_procs,validimages,validmasks,validlabels,rimages,qimages,\
                         imfeatures,masks,fore_global_hist,back_global_hist,\
                         qbins,totalbins,sigma,lambda_coef,nu,kernels,imtype,betas,\
-                        trial_beta1s,trial_beta3s,trial_lambdas,trial_nus):
+                        trial_beta1s,trial_beta3s,trial_lambdas,trial_nus,dtype='float64',sv_tol=0,\
+                        svm_solver='sklearn',bin_map=None,gram_max_bytes=256*2**20):
               
               
     #changing only beta1
@@ -654,50 +1744,51 @@ def cross_validate(n_procs,validimages,validmasks,validlabels,rimages,qimages,\
     
     all_configs = beta1_configs + beta3_configs + lambda_configs + nu_configs
 
-    """
-    (testimages,testmasks,testlabels,rimages,qimages,imfeatures,masks,\
-                        fore_global_hist,back_global_hist,qbins,totalbins,\
-                        sigma,lambda_coef,imtype,betas,alpha,support_vecs,queue):
-    """
-    def make_args(betas,lambda_coef,q,alpha,support_vecs):
-        return (validimages,validmasks,validlabels,rimages,qimages,imfeatures,masks\
-                    ,fore_global_hist,back_global_hist,qbins,totalbins,\
-                    sigma,lambda_coef,imtype,betas,alpha,support_vecs,q)
-     
-    jobs = []
-    job_qs = []
     alphas = []
+    full_alphas = []
     support_vec_arr = []
+    pending = []
     
-    for trial_betas,trial_lambda,trial_nu in all_configs:
-        q = Queue()
-        job_qs.append(q)
+    #one float64 gram buffer, refilled for every config, libsvm only works in float64
+    gram = np.empty((kernels.shape[1],kernels.shape[1]),'float64')
+    
+    #each config is evaluated on the validation images as soon as it is trained,
+    #while the next one trains
+    state = get_eval_state(rimages,qimages,imfeatures,masks,fore_global_hist,back_global_hist,\
+                            qbins,totalbins,sigma,imtype,dtype,sv_tol,bin_map)
+    shards = get_eval_shards(n_procs,state,len(validimages))
+    
+    for config_idx,(trial_betas,trial_lambda,trial_nu) in enumerate(all_configs):
         #kernels = np.load('600KERNEL.npy')
         #kernels = replace_theta(kernels,imfeatures,sigma)
         print 'Getting gram'
-        gram = get_graham_matrix(kernels,trial_betas)
+        get_graham_matrix(kernels,trial_betas,gram,gram_max_bytes)
         #gram = np.load('600GRAMNORAND.npy')
          
         print 'Training OC SVM'
-        ocSVM = svm.OneClassSVM(kernel='precomputed',nu=trial_nu)
-        ocSVM.fit(gram)
+        #neighbouring configs differ in one value, so the last solution is a close start
+        alpha0 = full_alphas[-1] if full_alphas else None
+        alpha,support_vecs,full_alpha = train_one_class_svm(gram,trial_nu,svm_solver,alpha0)
         
-        alpha = ocSVM.dual_coef_.flatten()
         alphas.append(alpha)
-        support_vecs = ocSVM.support_
+        full_alphas.append(full_alpha)
         support_vec_arr.append(support_vecs)
         
-        args = make_args(trial_betas,trial_lambda,q,alpha,support_vecs)
+        pending += [submit_eval_task(shards,(config_idx,i,validimages[i],validmasks[i],validlabels[i],\
+                        trial_betas,trial_lambda,alpha,support_vecs,False,False))\
+                        for i in range(len(validimages))]
+    
+    config_totals = np.zeros((len(all_configs),4))
+    for get_result in pending:
+        config_idx,_,counts,_,_,_ = get_result()
+        config_totals[config_idx] += accuracies_from_counts(counts)
+    close_eval_shards(shards)
+    
+    fullaccs = []
+    for a_acc,o_acc,fg_acc,bg_acc in config_totals/len(validimages):
+        accuracy = validation_accuracy(imtype,a_acc,o_acc,fg_acc,bg_acc)
+        fullaccs.append((accuracy,o_acc,a_acc,fg_acc,bg_acc))
         
-        proc = multiprocessing.Process(target=get_test_accuracy_worker, args=args)
-        jobs.append(proc)
-        proc.start()
-                                
-    for proc in jobs:
-        proc.join()
-    
-    
-    fullaccs = [q.get() for q in job_qs]
     accs = [t[0] for t in fullaccs]
     o_accs = [t[1] for t in fullaccs]
     a_accs = [t[2] for t in fullaccs]
@@ -734,24 +1825,69 @@ def cross_validate(n_procs,validimages,validmasks,validlabels,rimages,qimages,\
             "and best nu is",best_nu
     
     
-    gram = get_graham_matrix(kernels,best_betas)
+    get_graham_matrix(kernels,best_betas,gram,gram_max_bytes)
     
     print 'Training final model'
-    ocSVM = svm.OneClassSVM(kernel='precomputed',nu=best_nu)
-    ocSVM.fit(gram)
+    #the best nu config differs from the final one only in its betas
+    alpha,support_vecs,full_alpha = train_one_class_svm(gram,best_nu,svm_solver,full_alphas[best_nuidx])
         
-    alpha = ocSVM.dual_coef_.flatten()
     alphas.append(alpha)
-    support_vecs = ocSVM.support_
     support_vec_arr.append(support_vecs)
     
     return best_betas,best_lambda,support_vecs,alpha,best_nu
 
+#validation accuracy of the model trained on kernels computed in dtype, against a
+#float64 reference: a model trained with the same betas and nu on kernels64, the same
+#kernels computed in float64, with its potentials also in float64.
+#also the largest difference dtype makes to the gram matrix
+def get_precision_report(n_procs,validimages,validmasks,validlabels,rimages,qimages,\
+                        imfeatures,masks,fore_global_hist,back_global_hist,\
+                        qbins,totalbins,sigma,lambda_coef,kernels,kernels64,imtype,betas,nu,\
+                        alpha,support_vecs,dtype,bin_map=None,svm_solver='sklearn',gram_max_bytes=256*2**20):
+    #cross_validate trains on a float64 gram of the dtype kernels
+    gram = get_graham_matrix(kernels,betas,np.empty((kernels.shape[1],kernels.shape[1]),'float64'),\
+                gram_max_bytes)
+    gram64 = get_graham_matrix(kernels64,betas,np.empty((kernels.shape[1],kernels.shape[1]),'float64'),\
+                gram_max_bytes)
+    print 'Training float64 reference model'
+    alpha64,support_vecs64,_ = train_one_class_svm(gram64,nu,svm_solver)
+    gram64 -= gram
+    gram_delta = np.max(np.abs(gram64))
+    
+    accuracies = []
+    for d,a,svecs in [(dtype,alpha,support_vecs),('float64',alpha64,support_vecs64)]:
+        a_acc,o_acc,fg_acc,bg_acc,_ = get_test_accuracy(validimages,validmasks,validlabels,rimages,qimages,\
+                        imfeatures,masks,fore_global_hist,back_global_hist,qbins,totalbins,\
+                        sigma,lambda_coef,imtype,betas,a,svecs,n_procs=n_procs,dtype=d,\
+                        bin_map=bin_map)
+        accuracies.append(validation_accuracy(imtype,a_acc,o_acc,fg_acc,bg_acc))
+        
+    print "Validation accuracy in",dtype,"is",accuracies[0],"and in float64 is",accuracies[1]
+    print "Largest gram matrix difference is",gram_delta
+    return accuracies[0],accuracies[1],gram_delta
+
 #imtype is either 'flowers' or 'horses' 
 #n_procs is number of simulatneous processes to run on your machine
 #ntrain is number of images to use for training, ditto for test and validation
 #interactive=True if you want to see argmax test results, otherwise False
-def run_experiment(imtype,n_procs,ntrain,ntest,nvalid,interactive,flip_images=False):
+#kernel_dir is a shared directory to build the kernels in with get_distributed_kernels
+#dtype='float32' runs kernels, gram and inference in single precision, and with
+#precision_report=True also builds float64 reference kernels to compare it to a float64
+#model on the validation set (see get_precision_report)
+#stream_source is a video or image sequence to segment with segment_stream after testing,
+#stale_edges=True lets it keep the anchor frames' smoothing edges (see segment_stream)
+#sv_tol > 0 skips support vectors whose alpha*theta weight is below it at inference
+#svm_solver='warm' trains with fit_one_class_svm instead of sklearn, and benchmarks the two
+#pyramid_level > 0 computes the omega terms on images subsampled by 2**pyramid_level,
+#refining pairs with theta above refine_theta at full resolution
+#compact_bins=True histograms only the colour bins occupied in training (see get_bin_map),
+#which makes a finer qbins, given to override the per-imtype choice, affordable
+#parallel_cut=True splits each test image's graph cut across the processes, for large images
+#gram_max_bytes bounds the kernels and scratch get_graham_matrix holds in memory at once
+def run_experiment(imtype,n_procs,ntrain,ntest,nvalid,interactive,flip_images=False,kernel_dir=None,\
+                    dtype='float64',stream_source=None,sv_tol=0,svm_solver='sklearn',\
+                    pyramid_level=0,refine_theta=None,compact_bins=False,qbins=None,parallel_cut=False,\
+                    gram_max_bytes=256*2**20,stale_edges=False,precision_report=False):
     
     seed = int(time.time())
     np.random.seed(seed)
@@ -764,8 +1900,7 @@ def run_experiment(imtype,n_procs,ntrain,ntest,nvalid,interactive,flip_images=Fa
 
     #quantization bins per channel
     #TO start off, we will use this for all types
-    qbins = 16
-    totalbins = int(qbins**3)
+    imtype_qbins = 16
     
     #Also seems to work well in general, but may ultimately cross validate
     sigma = .25 
@@ -813,8 +1948,11 @@ def run_experiment(imtype,n_procs,ntrain,ntest,nvalid,interactive,flip_images=Fa
         trial_lambdas = [.5,.7,.9,1.5,1.8]
         trial_nus = [.25,.45]
         sigma = .5
-        qbins = 20
-        totalbins = int(qbins**3)
+        imtype_qbins = 20
+        
+    if qbins is None:
+        qbins = imtype_qbins
+    totalbins = int(qbins**3)
     
     print 'Loading images and test images'
     impaths,maskpaths = get_image_paths(imtype,rand_order)
@@ -839,14 +1977,32 @@ def run_experiment(imtype,n_procs,ntrain,ntest,nvalid,interactive,flip_images=Fa
         
     print 'Quantizing images'
     qimages = get_quantized_images(rimages,qbins,imtype)
+    bin_map = dense_bins = None
+    if compact_bins:
+        dense_bins = int(qbins**3)
+        bin_map,totalbins = get_bin_map(qimages,qbins)
+        qimages = remap_quantized_images(qimages,bin_map)
+        print 'Using',totalbins,'compact colour bins'
     print 'Extracting image features'
     imfeatures = get_image_features(rimages,imtype)
     print 'Getting global color histogram'
     fore_global_hist, back_global_hist = get_global_histograms(qimages,masks,totalbins)
 
+    log_dir = imtype+ "_testlog_" + str(seed)
+    os.mkdir(log_dir)
+    
     print 'Getting kernels'    
-    kernels = get_all_kernels(n_procs,n_images,imfeatures,qimages,masks\
-                    ,fore_global_hist,back_global_hist,totalbins,sigma)
+    kernel_qimages,kernel_masks = get_pyramid_level(qimages,masks,pyramid_level)
+    if kernel_dir:
+        kernels = get_distributed_kernels(n_procs,kernel_dir,n_images,imfeatures,kernel_qimages,kernel_masks\
+                    ,fore_global_hist,back_global_hist,totalbins,sigma,dtype=dtype,dense_bins=dense_bins)
+    else:
+        kernels = get_all_kernels(n_procs,n_images,imfeatures,kernel_qimages,kernel_masks\
+                    ,fore_global_hist,back_global_hist,totalbins,sigma,dtype,\
+                    os.path.join(log_dir,'kernels.npy'),dense_bins)
+    if pyramid_level > 0 and refine_theta is not None:
+        kernels = refine_kernels(n_procs,kernels.filename,refine_theta,qimages,masks,\
+                    fore_global_hist,back_global_hist,totalbins,dtype,dense_bins)
     
     
     print 'Cross validating'
@@ -854,37 +2010,90 @@ def run_experiment(imtype,n_procs,ntrain,ntest,nvalid,interactive,flip_images=Fa
     betas,lambda_coef,support_vecs,alpha,nu = cross_validate(n_procs,validimages,validmasks,validlabels,rimages,qimages,\
                                     imfeatures,masks,fore_global_hist,back_global_hist,\
                                     qbins,totalbins,sigma,lambda_coef,nu,kernels,imtype,betas,\
-                                    trial_beta1s,trial_beta3s,trial_lambdas,trial_nus)
+                                    trial_beta1s,trial_beta3s,trial_lambdas,trial_nus,dtype,sv_tol,\
+                                    svm_solver,bin_map,gram_max_bytes)
     
     print "After cross validating, choice of betas are",betas
     print "After cross validating, choice of lambda is",lambda_coef
     print "After cross validating, choice of nu is",nu
     
-    log_dir = imtype+ "_testlog_" + str(seed)
-    os.mkdir(log_dir)
-    
     log_f = open(os.path.join(log_dir,'results.txt'),'w')
     log_f.write("Betas chosen were {0}\n".format(str(betas)))
     log_f.write("lambda chosen was {0}\n".format(str(lambda_coef)))
     log_f.write("nu chosen was {0}\n".format(str(nu)))
     np.save(os.path.join(log_dir,"svecs.npy"),support_vecs)
     np.save(os.path.join(log_dir,"alpha.npy"),alpha)
-    np.save(os.path.join(log_dir,"kernels.npy"),kernels)
+    log_f.write("kernels are in {0}\n".format(os.path.abspath(kernels.filename)))
+    
+    if precision_report and dtype != 'float64':
+        print 'Getting float64 reference kernels'
+        kernels64 = get_all_kernels(n_procs,n_images,imfeatures,kernel_qimages,kernel_masks\
+                    ,fore_global_hist,back_global_hist,totalbins,sigma,'float64',\
+                    os.path.join(log_dir,'kernels64.npy'),dense_bins)
+        if pyramid_level > 0 and refine_theta is not None:
+            kernels64 = refine_kernels(n_procs,kernels64.filename,refine_theta,qimages,masks,\
+                    fore_global_hist,back_global_hist,totalbins,'float64',dense_bins)
+        
+        print 'Comparing precision on validation set'
+        acc,acc64,gram_delta = get_precision_report(n_procs,validimages,validmasks,validlabels,rimages,qimages,\
+                                    imfeatures,masks,fore_global_hist,back_global_hist,\
+                                    qbins,totalbins,sigma,lambda_coef,kernels,kernels64,imtype,betas,nu,\
+                                    alpha,support_vecs,dtype,bin_map,svm_solver,gram_max_bytes)
+        log_f.write("{0} validation accuracy was {1}\n".format(dtype,acc))
+        log_f.write("float64 validation accuracy was {0}\n".format(acc64))
+        log_f.write("accuracy delta was {0}\n".format(acc-acc64))
+        log_f.write("largest gram difference was {0}\n".format(gram_delta))
+        
+    if svm_solver == 'warm':
+        print 'Benchmarking one class SVM solvers'
+        gram = get_graham_matrix(kernels,betas,np.empty((kernels.shape[1],kernels.shape[1]),'float64'),\
+                    gram_max_bytes)
+        sk_time,warm_time,alpha_delta,agreement = benchmark_one_class_svm(gram,trial_nus)
+        log_f.write("sklearn nu path took {0}s, warm started path took {1}s\n".format(sk_time,warm_time))
+        log_f.write("largest alpha difference was {0}, support agreement was {1}\n".format(alpha_delta,agreement))
     log_f.close()
     
     print 'Getting test accuracy'
-    a_acc,o_acc,fg_acc,bg_acc = get_test_accuracy(testimages,testmasks,testlabels,rimages,qimages,imfeatures,masks,\
+    a_acc,o_acc,fg_acc,bg_acc,dropped = get_test_accuracy(testimages,testmasks,testlabels,rimages,qimages,imfeatures,masks,\
                         fore_global_hist,back_global_hist,qbins,totalbins,\
-                        sigma,lambda_coef,imtype,betas,alpha,support_vecs,interactive,log_dir)
+                        sigma,lambda_coef,imtype,betas,alpha,support_vecs,interactive,log_dir,\
+                        n_procs,dtype,sv_tol,bin_map,parallel_cut)
     
     log_f = open(os.path.join(log_dir,'results.txt'),'a')
     log_f.write("s_o accuracy average is {0}\n".format(o_acc))
     log_f.write("s_a accuracy average is {0}\n".format(a_acc))
     log_f.write("fg accuracy average is {0}\n".format(fg_acc))
     log_f.write("bg accuracy median is {0}\n".format(bg_acc))
+    if sv_tol > 0:
+        log_f.write("fraction of potential mass dropped by sv_tol averaged at most {0}\n".format(dropped))
     log_f.close()
     
+    if stream_source is not None:
+        print 'Segmenting stream'
+        stream_dir = os.path.join(log_dir,'stream')
+        os.mkdir(stream_dir)
+        fps = segment_stream(stream_source,rimages,qimages,imfeatures,masks,fore_global_hist,back_global_hist,\
+                    qbins,totalbins,sigma,lambda_coef,imtype,betas,alpha,support_vecs,\
+                    dtype=dtype,interactive=interactive,out_dir=stream_dir,bin_map=bin_map,\
+                    stale_edges=stale_edges)
+        log_f = open(os.path.join(log_dir,'results.txt'),'a')
+        log_f.write("stream frames per second was {0}\n".format(fps))
+        log_f.close()
+    
 if __name__ == '__main__':    
+    #python experiment.py kernel_worker <share_dir> computes tiles for a distributed kernel build
+    if len(sys.argv) == 3 and sys.argv[1] == 'kernel_worker':
+        run_kernel_worker(sys.argv[2])
+        sys.exit(0)
+    #python experiment.py pyramid_benchmark measures pyramid kernel speed and error on pennfudan
+    if len(sys.argv) == 2 and sys.argv[1] == 'pyramid_benchmark':
+        benchmark_pyramid_kernels(4)
+        sys.exit(0)
+    #python experiment.py cut_benchmark times the parallel graph cut against the single one
+    if len(sys.argv) == 2 and sys.argv[1] == 'cut_benchmark':
+        benchmark_parallel_cuts()
+        sys.exit(0)
+        
     #imtype, number of processors,# training images, #test images, #valid images, interactive mode, flip images
     #run_experiment('horses',4,10,10,10,False)
     #run_experiment('pedestrians',4,125,50,50,True)